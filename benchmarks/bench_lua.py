@@ -0,0 +1,192 @@
+#########################################
+# bench_lua.py
+#
+# Creation 2026-10-18
+#########################################
+"""
+rookout.lua 的性能测试。
+
+生成不同形状和大小的 lua table，测量 decode、decode_file、encode 和往返转换的
+吞吐量（MB/s）与内存峰值，结果保存为 json 文件，用于比较不同版本之间的变化。
+不需要网络，数据全部在本地生成，同样的参数总是生成同样的数据。
+
+用法::
+
+    python benchmarks/bench_lua.py --size 4 --output result.json
+    python benchmarks/bench_lua.py --compare old.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import rookout
+import rookout.lua as lua
+
+def _animation(rnd, i):
+    return {
+        'name': 'ani_bullet_hit_magic_%d' % i,
+        'delay_per_unit': round(rnd.random() / 10, 3),
+        'loops': rnd.randint(0, 3),
+        'restore_original_frames': rnd.random() < 0.5,
+        'frame_name': 'ani_bullet_hit_magic_%d_%%02d.png' % i,
+        'range': [1, rnd.randint(2, 60)],
+    }
+
+def gen_ani_def(rnd, n):
+    """与 tests/ani_def_sample.lua 相同结构的动画定义。"""
+    return {
+        'spritesheets': ['ani_misc%d' % i for i in range(max(1, n // 100))],
+        'animations': [_animation(rnd, i) for i in range(n)],
+    }
+
+def gen_numeric(rnd, n):
+    """大量数字数组，例如帧坐标和瓦片地图。"""
+    return [[rnd.randint(0, 4096) for _ in range(64)] for _ in range(n)]
+
+def gen_floats(rnd, n):
+    return [[round(rnd.uniform(-1000, 1000), 4) for _ in range(64)] for _ in range(n)]
+
+def gen_long_strings(rnd, n):
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'rookout', 'zrong']
+    return [' '.join(rnd.choice(words) for _ in range(200)) for _ in range(n)]
+
+def gen_wide(rnd, n):
+    """只有一层，但包含大量键值对。"""
+    return {'key_%d' % i: rnd.randint(0, 1 << 30) for i in range(n * 50)}
+
+def gen_deep(rnd, n):
+    """嵌套很深的 table。"""
+    items = []
+    for i in range(n):
+        node = {'leaf': i}
+        for depth in range(40):
+            node = {'depth': depth, 'child': node}
+        items.append(node)
+    return items
+
+def gen_mixed(rnd, n):
+    return [{
+        'id': i,
+        'name': 'item_%d' % i,
+        'scale': rnd.random(),
+        'visible': rnd.random() < 0.5,
+        'points': [rnd.randint(0, 999) for _ in range(16)],
+        'tags': ['a', 'b', 'c'],
+        'meta': {'owner': 'zrong', 'level': rnd.randint(1, 99)},
+    } for i in range(n)]
+
+SHAPES = {
+    'ani_def': (gen_ani_def, 4800),
+    'numeric': (gen_numeric, 3400),
+    'floats': (gen_floats, 1750),
+    'long_strings': (gen_long_strings, 900),
+    'wide': (gen_wide, 790),
+    'deep': (gen_deep, 270),
+    'mixed': (gen_mixed, 3800),
+}
+"""形状名称 -> (生成函数, 生成约 1MB lua 源码所需的数量)"""
+
+def measure(func, arg, repeat):
+    """运行 repeat 次，返回最短时间（秒）和内存峰值（字节）。"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    func(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def run(size, repeat, shapes, seed=20141023):
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix='rookout_bench_')
+    try:
+        for shape in shapes:
+            gen, per_mb = SHAPES[shape]
+            obj = gen(random.Random(seed), max(1, int(per_mb * size)))
+            text = lua.encode(obj)
+            luafile = os.path.join(tmpdir, shape + '.lua')
+            with open(luafile, 'w', encoding='utf-8') as f:
+                f.write(text)
+            mb = len(text.encode('utf-8')) / (1024 * 1024)
+            cases = {
+                'decode': (lua.decode, text),
+                'decode_file': (lua.decode_file, luafile),
+                'encode': (lua.encode, obj),
+                'roundtrip': (lambda t: lua.encode(lua.decode(t)), text),
+            }
+            result = {'mb': round(mb, 3)}
+            for name, (func, arg) in cases.items():
+                elapsed, peak = measure(func, arg, repeat)
+                result[name] = {
+                    'seconds': round(elapsed, 6),
+                    'mb_per_s': round(mb / elapsed, 3) if elapsed else None,
+                    'peak_mb': round(peak / (1024 * 1024), 3),
+                }
+            results[shape] = result
+            print('%-14s %7.2fMB  %s' % (shape, mb, '  '.join(
+                '%s %.2fMB/s' % (name, result[name]['mb_per_s']) \
+                    for name in cases)))
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+    return {
+        'rookout': rookout.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'size': size,
+        'repeat': repeat,
+        'results': results,
+    }
+
+def compare(old, new):
+    """打印新旧两次结果中 MB/s 的比值，大于 1 代表变快了。"""
+    for shape, result in new['results'].items():
+        before = old['results'].get(shape)
+        if not before:
+            continue
+        ratios = []
+        for name, value in result.items():
+            if name == 'mb' or name not in before:
+                continue
+            ratios.append('%s x%.2f' % (name,
+                value['mb_per_s'] / before[name]['mb_per_s']))
+        print('%-14s %s' % (shape, '  '.join(ratios)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='rookout.lua benchmark')
+    parser.add_argument('--size', type=float, default=1,
+        help='每种形状生成的 lua 源码大小，单位 MB。')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='每项测试的重复次数，取最短时间。')
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+        help='只测试指定的形状，可以重复使用。')
+    parser.add_argument('--output', help='将结果保存到 json 文件。')
+    parser.add_argument('--compare', help='与之前保存的 json 结果进行比较。')
+    args = parser.parse_args(argv)
+    data = run(args.size, args.repeat, args.shape or sorted(SHAPES))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), data)
+
+if __name__ == '__main__':
+    main()
@@ -18,82 +18,373 @@
 import os
 import re
 import sys
+import zlib
 import zipfile
 import shutil
+import fnmatch
 import hashlib
+import json
+import mmap
+import struct
 import tempfile
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from string import Template
 from rookout import slog
 
-def list_dir(sourceDir, include_source=None, include_file=True):
+def list_dir(sourceDir, include_source=None, include_file=True, entries=False):
     """与 :func:`os.listdir()` 类似，但提供一些筛选功能，且返回生成器对象。
 
+    使用 :func:`os.scandir()` 遍历，文件类型由目录项直接提供，不需要为每个文件调用 stat 。
+
     :param str sourceDir: 待处理的文件夹。
     :param bool include_source: 遍历结果中是否包含源文件夹的路径。
     :param bool include_file:    是否包含文件。True 表示返回的内容中既包含文件，又
                                 包含文件夹；Flase 代表仅包含文件夹。
+    :param bool entries: 为 True 时返回 :class:`os.DirEntry` 对象，
+                         可以直接使用其中的文件类型和 stat 信息，此时忽略 include_source。
     :return: 一个生成器对象。
 
     """
-    for cur_file in os.listdir(sourceDir):
-        if cur_file.lower() == ".ds_store":
-            continue
-        pathWithSource = os.path.join(sourceDir, cur_file)
-        if include_file or os.path.isdir(pathWithSource):
-            if include_source:
-                yield pathWithSource
-            else:
-                yield cur_file
+    with os.scandir(sourceDir) as it:
+        for entry in it:
+            if entry.name.lower() == ".ds_store":
+                continue
+            if include_file or entry.is_dir():
+                if entries:
+                    yield entry
+                elif include_source:
+                    yield os.path.join(sourceDir, entry.name)
+                else:
+                    yield entry.name
 
-def copy_dir(sou_dir, dst_dir, del_dst=False, del_subdst=False):
+def copy_dir(sou_dir, dst_dir, del_dst=False, del_subdst=False,
+        incremental=False, compare='mtime+size', delete=False,
+        workers=None, link=False):
     """:func:`shutil.copytree()` 也能实现类似功能，
     但前者要求目标文件夹必须不存在。
     而 copy_dir 没有这个要求，它可以将 sou_dir 中的文件合并到 dst_dir 中。
 
+    复制文件时会保留文件的修改时间，以便下一次使用 incremental 时进行比较。
+    在 Linux 中优先使用 reflink （文件系统支持时只复制元数据），
+    其次是 :func:`os.copy_file_range()` ，数据不经过用户空间。
+
     :param str sou_dir: 待复制的文件夹；
     :param str dst_dir: 目标文件夹；
     :param bool del_dst: 是否删除目标文件夹。
     :param bool del_subdst: 是否删除目标子文件夹。
+    :param bool incremental: 为 True 时跳过没有改变的文件。
+    :param str compare: 判断文件是否改变的方式。
+                        ``mtime+size`` 比较文件大小和修改时间（精确到秒）；
+                        ``hash`` 比较文件大小和 MD5 值。
+    :param bool delete: 为 True 时删除 dst_dir 中在 sou_dir 里不存在的文件和文件夹。
+    :param int workers: 大于 1 时使用这么多线程同时复制（和比较）文件，
+                        适合复制大量的小文件。
+    :param bool link: 为 True 时创建硬链接而不是复制，适合不会再被修改的构建结果。
+                      无法创建硬链接时（例如跨文件系统）仍然复制文件。
+    :returns: 一个 dict ，包含 copied 、 skipped 、 deleted 三个列表，
+              分别是复制、跳过和删除的文件，使用相对于 sou_dir （或 dst_dir）
+              的路径，以 / 分隔。
+    :rtype: dict
 
     """
-    if del_dst and os.path.isdir(del_dst):
+    if compare not in ('mtime+size', 'hash'):
+        raise ValueError('compare must be "mtime+size" or "hash", not %r.'%compare)
+    if del_dst and os.path.isdir(dst_dir):
         shutil.rmtree(dst_dir)
     os.makedirs(dst_dir, exist_ok=True)
-    for cur_file in list_dir(sou_dir):
-        dst_file = os.path.join(dst_dir, cur_file)
-        cur_file = os.path.join(sou_dir, cur_file)
-        if os.path.isdir(cur_file):
-            if del_subdst and os.path.isdir(dst_file):
-                shutil.rmtree(dst_file)
-            os.makedirs(dst_file, exist_ok=True)
-            copy_dir(cur_file, dst_file)
-        else:
-            shutil.copyfile(cur_file, dst_file)
+    result = {'copied':[], 'skipped':[], 'deleted':[]}
+    def sync(entry, dst_file):
+        if incremental and _same_file(entry, dst_file, compare):
+            return 'skipped'
+        _copy_file(entry, dst_file, link)
+        return 'copied'
+    executor = None
+    if workers and workers > 1:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        # 按照遍历的顺序记录结果，同时限制尚未完成的任务数量
+        pending = deque()
+        limit = workers * 16
+    sou_files = set()
+    sou_dirs = set()
+    stack = [(sou_dir, '')]
+    try:
+        while stack:
+            top, prefix = stack.pop()
+            files, dirs = _scan_dir(top, prefix, None, True, None, None, True)
+            dirs = [d for d in dirs if not d[1].lower().endswith('.ds_store/')]
+            for _, relpath in dirs:
+                sou_dirs.add(relpath[:-1])
+                dst_file = os.path.join(dst_dir, relpath)
+                if del_subdst and not prefix and os.path.isdir(dst_file):
+                    shutil.rmtree(dst_file)
+                os.makedirs(dst_file, exist_ok=True)
+            for entry, relpath in files:
+                if entry.name.lower() == ".ds_store":
+                    continue
+                sou_files.add(relpath)
+                dst_file = os.path.join(dst_dir, relpath)
+                if executor is None:
+                    result[sync(entry, dst_file)].append(relpath)
+                    continue
+                pending.append((relpath, executor.submit(sync, entry, dst_file)))
+                while len(pending) > limit:
+                    relpath, future = pending.popleft()
+                    result[future.result()].append(relpath)
+            stack.extend(reversed(dirs))
+        while executor is not None and pending:
+            relpath, future = pending.popleft()
+            result[future.result()].append(relpath)
+    finally:
+        if executor is not None:
+            # 出错时取消尚未开始的复制，并等待正在进行的复制结束后再返回
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+    if delete:
+        result['deleted'] = _delete_orphans(dst_dir, sou_files, sou_dirs)
+    return result
+
+# linux/fs.h 中的 FICLONE
+_FICLONE = 0x40049409
+
+def _copy_file(entry, dst_file, link=False):
+    """复制 entry 对应的文件，并保留它的修改时间。"""
+    st = entry.stat()
+    try:
+        dst_st = os.stat(dst_file)
+    except OSError:
+        dst_st = None
+    if dst_st is not None and (link or os.path.samestat(st, dst_st)):
+        # 目标是源文件的硬链接时，直接写入会破坏源文件
+        os.remove(dst_file)
+    if link:
+        try:
+            os.link(entry.path, dst_file)
+            return
+        except OSError:
+            pass
+    _copy_data(entry.path, dst_file, st.st_size)
+    os.utime(dst_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def _copy_data(src, dst, size):
+    """在内核中复制文件内容，不支持时使用 :func:`shutil.copyfile()` 。"""
+    if sys.platform.startswith('linux') and size:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            infd, outfd = fsrc.fileno(), fdst.fileno()
+            if _reflink(infd, outfd) or _copy_range(infd, outfd, size):
+                return
+    shutil.copyfile(src, dst)
+
+def _reflink(infd, outfd):
+    import fcntl
+    try:
+        fcntl.ioctl(outfd, _FICLONE, infd)
+    except OSError:
+        return False
+    return True
+
+def _copy_range(infd, outfd, size):
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        return False
+    copied = 0
+    try:
+        while copied < size:
+            n = copy_file_range(infd, outfd, size - copied)
+            if not n:
+                break
+            copied += n
+    except OSError:
+        return False
+    # 某些文件系统会错误地返回 0 ，此时交给 shutil.copyfile 重新复制
+    return copied == size
+
+def _same_file(entry, dst_file, compare):
+    try:
+        dst_st = os.stat(dst_file)
+    except OSError:
+        return False
+    st = entry.stat()
+    if st.st_size != dst_st.st_size:
+        return False
+    if compare == 'hash':
+        return get_md5(entry.path) == get_md5(dst_file)
+    return int(st.st_mtime) == int(dst_st.st_mtime)
+
+def _delete_orphans(dst_dir, sou_files, sou_dirs):
+    """删除 dst_dir 中不在 sou_files 和 sou_dirs 中的文件和文件夹，返回被删除的文件列表。"""
+    deleted = []
+    for top, dirs, files in os.walk(dst_dir, topdown=False):
+        rel = os.path.relpath(top, dst_dir)
+        prefix = '' if rel == os.curdir else rel.replace(os.sep, '/') + '/'
+        for name in files:
+            relpath = prefix + name
+            if relpath not in sou_files:
+                os.remove(os.path.join(top, name))
+                deleted.append(relpath)
+        if prefix and prefix[:-1] not in sou_dirs:
+            try:
+                os.rmdir(top)
+            except OSError:
+                pass
+    return deleted
+
+def _compile_patterns(patterns):
+    """将 glob 模式编译成一对匹配函数 ``(match_name, match_path)`` 。
+
+    包含 / 的模式匹配相对路径，其他模式只匹配文件名，与 .gitignore 的规则类似。
+    patterns 也可以是编译好的正则表达式，它用于搜索相对路径。
+    相对路径总是使用 / 作为分隔符。
+    """
+    if patterns is None:
+        return None
+    if hasattr(patterns, 'search'):
+        return (None, patterns.search)
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    names = [fnmatch.translate(pat) for pat in patterns if '/' not in pat]
+    paths = [fnmatch.translate(pat.strip('/')) for pat in patterns if '/' in pat]
+    return (re.compile('|'.join(names)).match if names else None,
+            re.compile('|'.join(paths)).match if paths else None)
+
+def _match(matchers, name, relpath):
+    match_name, match_path = matchers
+    if match_name is not None and match_name(name):
+        return True
+    return match_path is not None and match_path(relpath) is not None
+
+def _scan_dir(top, prefix, ext, include, includes, excludes,
+        follow_symlinks=False):
+    """读取一个文件夹，返回 ``(files, dirs)`` 。
+
+    files 是符合条件的 ``(entry, relpath)`` 列表，dirs 是需要继续遍历的
+    ``(path, prefix)`` 列表。includes 和 excludes 是编译好的匹配函数。
+    与 :func:`os.walk()` 相同，忽略无法读取的文件夹；
+    follow_symlinks 为 False 时不进入指向文件夹的符号链接。
+    """
+    files = []
+    dirs = []
+    try:
+        it = os.scandir(top)
+    except OSError:
+        return files, dirs
+    with it:
+        for entry in it:
+            name = entry.name
+            relpath = prefix + name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if excludes and _match(excludes, name, relpath):
+                    continue
+                if follow_symlinks or not entry.is_symlink():
+                    dirs.append((entry.path, relpath + '/'))
+                continue
+            if ext and name.endswith(ext) is not include:
+                continue
+            if includes and not _match(includes, name, relpath):
+                continue
+            if excludes and _match(excludes, name, relpath):
+                continue
+            files.append((entry, relpath))
+    return files, dirs
+
+def _walk(path, ext=None, include=True, includes=None, excludes=None):
+    """使用 :func:`os.scandir()` 遍历 path 中的所有文件，生成 ``(entry, relpath)`` 。
+
+    顺序与 :func:`os.walk()` 相同：先是一个文件夹中的文件，然后依次进入子文件夹。
+    与 excludes 匹配的文件夹不会被进入。
+    """
+    includes = _compile_patterns(includes)
+    excludes = _compile_patterns(excludes)
+    stack = [(path, '')]
+    while stack:
+        top, prefix = stack.pop()
+        files, dirs = _scan_dir(top, prefix, ext, include, includes, excludes)
+        yield from files
+        stack.extend(reversed(dirs))
 
-def get_files(path, ext=[], include=True):
+def _walk_parallel(path, workers, ordered=False, ext=None, include=True,
+        includes=None, excludes=None):
+    """与 :func:`_walk()` 相同，但使用线程池同时读取多个文件夹。
+
+    同时读取的文件夹最多为 workers 的 4 倍，只有调用者取走结果之后才会继续读取，
+    因此内存占用是有限的；生成器被关闭时，尚未开始的读取会被取消。
+    ordered 为 True 时结果的顺序与 :func:`_walk()` 相同，
+    此时线程池提前读取的是按照遍历顺序即将用到的文件夹。
+    """
+    filters = (ext, include, _compile_patterns(includes),
+            _compile_patterns(excludes))
+    limit = workers * 4
+    stack = [(path, '')]
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            if ordered:
+                while stack:
+                    for item in stack[-limit:]:
+                        if item not in running:
+                            running[item] = executor.submit(
+                                    _scan_dir, item[0], item[1], *filters)
+                    files, dirs = running.pop(stack.pop()).result()
+                    yield from files
+                    stack.extend(reversed(dirs))
+            else:
+                while stack or running:
+                    while stack and len(running) < limit:
+                        item = stack.pop()
+                        future = executor.submit(
+                                _scan_dir, item[0], item[1], *filters)
+                        running[future] = item
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        del running[future]
+                        files, dirs = future.result()
+                        stack.extend(dirs)
+                        yield from files
+        finally:
+            for future in running.values() if ordered else running:
+                future.cancel()
+
+def get_files(path, ext=[], include=True, includes=None, excludes=None,
+        entries=False, workers=None, ordered=True):
     """遍历提供的文件夹的所有子文件夹，饭后生成器对象。
 
+    使用 :func:`os.scandir()` 遍历，文件类型由目录项直接提供；
+    扩展名使用一次 :meth:`str.endswith()` 判断，筛选模式在遍历之前编译一次。
+
     :param str path: 待处理的文件夹。
     :param list ext: 扩展名列表。
     :param bool include:    若值为 True，代表 ext 提供的是包含列表；
                             否则是排除列表。
+    :param includes: 只返回与这些 glob 模式匹配的文件，可以是一个模式、模式列表
+                     或者编译好的正则表达式。不包含 / 的模式匹配文件名，
+                     包含 / 的模式匹配相对于 path 的路径（使用 / 分隔）；
+                     正则表达式搜索相对路径。
+    :param excludes: 排除与这些模式匹配的文件和文件夹，写法与 includes 相同。
+                     被排除的文件夹不会被遍历。
+    :param bool entries: 为 True 时返回 :class:`os.DirEntry` 对象，
+                         可以直接使用其中的 stat 信息，不必再次调用 stat 。
+    :param int workers: 大于 1 时使用这么多线程同时读取多个文件夹，
+                        适用于网络文件系统或者非常大的文件夹。
+    :param bool ordered: 使用多个线程时，是否保持与单线程相同的顺序。
+                         为 False 时按照文件夹读取完成的顺序返回，速度更快。
     :returns: 一个生成器对象。 
 
     """
-    has_ext = len(ext)>0
-    for p, d, fs in os.walk(path):
-        for f in fs:
-            if has_ext:
-                in_ext = False
-                for name in ext:
-                    if f.endswith(name):
-                        in_ext = True
-                        break
-                if (include and in_ext) or \
-                (not include and not in_ext):
-                    yield os.path.join(p,f)
-            else:
-                yield os.path.join(p, f)
+    ext = tuple(ext)
+    if workers and workers > 1:
+        walker = _walk_parallel(path, workers, ordered, ext, include,
+                includes, excludes)
+    else:
+        walker = _walk(path, ext, include, includes, excludes)
+    for entry, _ in walker:
+        yield entry if entries else entry.path
 
 def read_file(file_path, **kws):
     """读取文本文件的内容。
@@ -146,58 +437,662 @@ def write_by_templ(templ, target, sub_value, safe=False):
         txt = Template(templ_txt).substitute(sub_value)
     write_file(target, txt)
 
-def get_md5(path):
+def get_md5(path, chunk_size=1<<20):
     """获取文件的 MD5 值。
 
+    文件被分块读取，内存占用与文件大小无关。
+
     :param str path: 文件路径。
+    :param int chunk_size: 每次读取的字节数。
     :returns: MD5 值。
     :rtype: str
 
     """
-    with open(path,'rb') as f:
-        md5obj = hashlib.md5()
-        md5obj.update(f.read())
-        return md5obj.hexdigest()
-    raise FileNotFoundError("Error when get md5 for %s!"%path)
+    return get_hashes(path, ('md5',), chunk_size)['md5']
+
+def get_hashes(path, algorithms=('md5',), chunk_size=1<<20, use_mmap=False):
+    """读取一遍文件，同时计算多个 hash 值。
+
+    文件被分块读入同一个缓冲区中，每一块依次交给每个 hash 对象，
+    内存占用与文件大小无关。
+
+    :param str path: 文件路径。
+    :param list algorithms: :func:`hashlib.new()` 支持的算法名称，
+                            例如 md5 、 sha1 、 sha256 、 blake2b 。
+    :param int chunk_size: 每次读取的字节数。
+    :param bool use_mmap: 为 True 时将文件映射到内存，不再复制到缓冲区中。
+    :returns: 算法名称到 16 进制 hash 值的映射。
+    :rtype: dict
+
+    """
+    hashers = [(name, hashlib.new(name)) for name in algorithms]
+    updates = [h.update for _, h in hashers]
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if use_mmap and size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                try:
+                    for pos in range(0, size, chunk_size):
+                        chunk = view[pos:pos+chunk_size]
+                        for update in updates:
+                            update(chunk)
+                        chunk.release()
+                finally:
+                    view.release()
+        else:
+            buf = bytearray(chunk_size)
+            view = memoryview(buf)
+            readinto = f.readinto
+            while True:
+                n = readinto(buf)
+                if not n:
+                    break
+                chunk = view[:n] if n < chunk_size else view
+                for update in updates:
+                    update(chunk)
+    return {name:h.hexdigest() for name, h in hashers}
+
+def get_md5_many(paths, workers=None, algorithms=None, chunk_size=1<<20):
+    """使用多个线程同时计算多个文件的 MD5 值。
+    hashlib 在计算时会释放 GIL ，因此多个线程可以真正地同时计算。
+
+    :param list paths: 文件路径列表。
+    :param int workers: 线程数量，默认为 CPU 核心数。
+    :param list algorithms: 提供时计算这些算法的 hash 值，参见 :func:`get_hashes()` ，
+                            此时每个文件对应一个 dict 。
+    :param int chunk_size: 每次读取的字节数。
+    :returns: 文件路径到 MD5 值（或者 hash 值的 dict）的映射，顺序与 paths 相同。
+    :rtype: dict
+
+    """
+    paths = list(paths)
+    if algorithms is None:
+        def hash_file(path):
+            return get_md5(path, chunk_size)
+    else:
+        def hash_file(path):
+            return get_hashes(path, algorithms, chunk_size)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(paths) <= 1:
+        return {path:hash_file(path) for path in paths}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paths, executor.map(hash_file, paths)))
+
+class Manifest(object):
+    """一个文件夹中所有文件的索引，保存每个文件的大小、修改时间和 hash 值。
+
+    :meth:`update()` 只重新计算大小或修改时间改变了的文件的 hash 值，
+    :meth:`diff()` 根据 hash 值比较两个索引，找出增加、删除和修改的文件。
+    索引可以使用 :meth:`save()` 保存为 JSON 文件，下一次运行时用 :meth:`load()` 读取。
+
+    >>> manifest = Manifest.load('assets.json', 'assets')
+    >>> changes = manifest.update()
+    >>> manifest.save('assets.json')
+    >>> changes['modified']
+    ['ui/button.png']
+
+    :param str root: 文件夹路径。
+    :param str algorithm: hash 算法，参见 :func:`get_hashes()` 。
+    :param dict entries: 相对路径（以 / 分隔）到 ``(size, mtime_ns, hash)`` 的映射。
+
+    """
+
+    def __init__(self, root, algorithm='md5', entries=None):
+        self.root = root
+        self.algorithm = algorithm
+        self.entries = entries if entries is not None else {}
+
+    @classmethod
+    def load(cls, path, root=None):
+        """读取 :meth:`save()` 保存的索引，文件不存在时返回一个空的索引。
+
+        :param str path: 索引文件路径。
+        :param str root: 提供时替换索引中保存的文件夹路径。
+                         索引文件不存在时必须提供。
+        :returns: :class:`Manifest`
+        :raise: :class:`ValueError`
+
+        """
+        if not os.path.exists(path):
+            if root is None:
+                raise ValueError('root is required because "%s" does not exist.'%path)
+            return cls(root)
+        data = json.loads(read_file(path))
+        entries = {k:tuple(v) for k, v in data['files'].items()}
+        return cls(root or data['root'], data['algorithm'], entries)
+
+    def save(self, path):
+        """将索引保存为 JSON 文件，先写入临时文件再替换，不会留下写了一半的文件。"""
+        data = {'root':self.root, 'algorithm':self.algorithm,
+                'files':self.entries}
+        updir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(updir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8',
+                dir=updir, delete=False) as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(f.name, path)
+
+    def update(self, ext=[], include=True, includes=None, excludes=None,
+            workers=None):
+        """重新遍历文件夹，更新索引。
+
+        大小和修改时间都没有改变的文件直接使用原来的 hash 值，
+        其他文件使用 :func:`get_md5_many()` 并行计算。
+        筛选参数与 :func:`get_files()` 相同。
+
+        :param int workers: 计算 hash 值的线程数量，默认为 CPU 核心数。
+        :returns: 更新前后的差异，参见 :meth:`diff()` 。
+        :rtype: dict
+
+        """
+        old = self.entries
+        entries = {}
+        stale = {}
+        for entry, relpath in _walk(self.root, tuple(ext), include,
+                includes, excludes):
+            st = entry.stat()
+            item = old.get(relpath)
+            if item and item[0] == st.st_size and item[1] == st.st_mtime_ns:
+                entries[relpath] = item
+            else:
+                stale[entry.path] = (relpath, st.st_size, st.st_mtime_ns)
+        algorithm = self.algorithm
+        hashes = get_md5_many(stale, workers, [algorithm])
+        for path, (relpath, size, mtime) in stale.items():
+            entries[relpath] = (size, mtime, hashes[path][algorithm])
+        self.entries = entries
+        return Manifest.diff(old, entries)
+
+    @staticmethod
+    def diff(old, new):
+        """比较两个索引。
 
-def create_zip(files, trim_arcname=None, target_file=None, **zipfile_args):
+        :param old: 旧的 :class:`Manifest` 或者它的 entries 。
+        :param new: 新的 :class:`Manifest` 或者它的 entries 。
+        :returns: 一个 dict ，包含 added 、 removed 、 modified 三个排序后的相对路径列表。
+                  hash 值相同的文件即使修改时间不同也不算作修改。
+        :rtype: dict
+
+        """
+        if isinstance(old, Manifest):
+            old = old.entries
+        if isinstance(new, Manifest):
+            new = new.entries
+        old_keys = old.keys()
+        new_keys = new.keys()
+        return {'added':sorted(new_keys - old_keys),
+                'removed':sorted(old_keys - new_keys),
+                'modified':sorted(k for k in new_keys & old_keys \
+                        if new[k][2] != old[k][2])}
+
+STORE_EXT = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.pkm', '.ktx', '.astc',
+        '.ogg', '.mp3', '.m4a', '.aac', '.mp4', '.webm',
+        '.zip', '.jar', '.apk', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar')
+"""这些扩展名的文件已经是压缩过的，:func:`create_zip()` 直接存储它们而不再压缩。"""
+
+# 超过这个大小的文件不读入内存，仍然在主线程中使用 ZipFile.write 写入
+_RAW_LIMIT = 1<<26
+
+def _compress(data, compression, level):
+    if compression == zipfile.ZIP_DEFLATED:
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+    import bz2
+    return bz2.compress(data, level or 9)
+
+def _incompressible(data):
+    """用最快的压缩级别压缩开头的一部分，几乎没有变小时认为整个文件都无法压缩。"""
+    sample = data[:1<<16]
+    return len(zlib.compress(sample, 1)) > len(sample) * 0.95
+
+def _compress_member(path, arcname, compression, level, store_ext):
+    """读取并压缩一个文件，返回 ``(zinfo, data)`` 。在线程池中调用，zlib 会释放 GIL 。"""
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    with open(path, 'rb') as f:
+        data = f.read()
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    if compression != zipfile.ZIP_STORED:
+        if path.lower().endswith(store_ext) or \
+                (len(data) > 1<<17 and _incompressible(data)):
+            compression = zipfile.ZIP_STORED
+        else:
+            packed = _compress(data, compression, level)
+            if len(packed) < len(data):
+                data = packed
+            else:
+                compression = zipfile.ZIP_STORED
+    zinfo.compress_type = compression
+    return zinfo, data
+
+def _write_raw(zipf, zinfo, data, length=None):
+    """将已经压缩好的数据作为一个成员写入 zipf 。
+
+    zipfile 没有提供这个接口，这里按照 ZipFile._open_to_write 的方式直接写入。
+    zinfo 中的 CRC 、 file_size 和 compress_type 必须已经设置好。
+    提供 length 时 data 是一个文件对象，从它的当前位置分块复制 length 个字节。
+    """
+    if zipf._writing:
+        raise ValueError("Can't write to the ZIP file while there is "
+                "another write handle open on it.")
+    zinfo.compress_size = len(data) if length is None else length
+    if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or \
+            zinfo.compress_size > zipfile.ZIP64_LIMIT
+    if zip64 and not zipf._allowZip64:
+        raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+    with zipf._lock:
+        if zipf._seekable:
+            zipf.fp.seek(zipf.start_dir)
+        zinfo.header_offset = zipf.fp.tell()
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        if length is None:
+            zipf.fp.write(data)
+        else:
+            while length:
+                chunk = data.read(min(length, 1<<20))
+                if not chunk:
+                    raise zipfile.BadZipFile('Truncated entry %r'%zinfo.filename)
+                zipf.fp.write(chunk)
+                length -= len(chunk)
+        zipf.start_dir = zipf.fp.tell()
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+
+ZipProgress = namedtuple('ZipProgress', 'files total_files bytes elapsed throughput')
+"""传给 progress 回调函数的进度信息。
+
+files 和 bytes 是已经写入的文件数和未压缩的字节数， total_files 是文件总数，
+elapsed 是已经使用的秒数， throughput 是平均每秒处理的未压缩字节数。
+"""
+
+def print_progress(stats):
+    """默认的 progress 回调函数，在标准输出中显示百分比，全部完成后换行。"""
+    percent = stats.files*100//stats.total_files if stats.total_files else 100
+    sys.stdout.write('\r%d%%'%percent)
+    if stats.files == stats.total_files:
+        sys.stdout.write('\n')
+    sys.stdout.flush()
+
+class _Progress(object):
+    """统计写入的文件数和字节数，每隔 interval 秒最多调用一次 callback 。"""
+
+    def __init__(self, callback, total_files, interval):
+        self.callback = callback
+        self.total_files = total_files
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+        self.last = None
+        self.reported = -1
+
+    def add(self, nbytes):
+        self.files += 1
+        self.bytes += nbytes
+        if not self.callback:
+            return
+        now = time.perf_counter()
+        if self.last is None or now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+
+    def finish(self):
+        # 最后一次 add 已经报告过时不再重复
+        if self.callback and self.reported != self.files:
+            self.report(time.perf_counter())
+
+    def report(self, now):
+        self.reported = self.files
+        elapsed = now - self.start
+        throughput = self.bytes/elapsed if elapsed > 0 else 0.0
+        self.callback(ZipProgress(self.files, self.total_files, self.bytes,
+                elapsed, throughput))
+
+def _write_members(zipf, members, workers, store_ext, progress):
+    """按照顺序将 members 写入 zipf 。
+
+    每个 member 是 ``(path, arcname, raw)`` ，raw 不为 None 时是一个函数，
+    调用它直接写入已经压缩好的数据；否则读取并压缩 path 。
+    workers 大于 1 时在线程池中压缩，内存中最多保留 workers 的 4 倍个等待写入的文件。
+    每写入一个成员之后调用一次 ``progress.add(nbytes)`` 。
+    """
+    compression = zipf.compression
+    level = zipf.compresslevel
+    if compression not in (zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_STORED):
+        workers = None
+
+    def write(path, arcname, raw, future):
+        if raw is not None:
+            raw()
+        elif future is not None:
+            _write_raw(zipf, *future.result())
+        elif store_ext and path.lower().endswith(store_ext):
+            zipf.write(path, arcname, zipfile.ZIP_STORED)
+        else:
+            zipf.write(path, arcname)
+        progress.add(zipf.filelist[-1].file_size)
+
+    if not workers or workers <= 1:
+        for path, arcname, raw in members:
+            write(path, arcname, raw, None)
+        return
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, arcname, raw in members:
+            future = None
+            if raw is None and os.path.isfile(path) and \
+                    os.path.getsize(path) <= _RAW_LIMIT:
+                future = executor.submit(_compress_member, path, arcname,
+                        compression, level, store_ext)
+            pending.append((path, arcname, raw, future))
+            while len(pending) > workers * 4:
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+
+def create_zip(files, trim_arcname=None, target_file=None, workers=None,
+        store_ext=STORE_EXT, progress=print_progress, progress_interval=0.5,
+        **zipfile_args):
     """创建一个 zip 文件。
 
     :param list files: 要创建zip 的文件列表。
     :param int trim_arcname: 若提供这个值，则使用 ZipFile.write(filename, filename[trim_arcname:]) 进行调用。
-    :returns: zip 文件的路径。
+    :param target_file: zip 文件的路径，或者一个可写的文件对象。
+                        文件对象可以不支持 seek ，例如管道或 socket.makefile('wb') ，
+                        此时 zip 以流的方式写入，不需要临时文件。
+                        传入的文件对象不会被关闭。
+                        默认为 None ，此时写入一个临时文件。
+    :param int workers: 大于 1 时使用这么多线程同时读取和压缩文件，
+                        然后按照 files 的顺序写入 zip 文件。
+                        仅支持 ZIP_DEFLATED 、 ZIP_BZIP2 和 ZIP_STORED 。
+    :param tuple store_ext: 这些扩展名（小写）的文件直接存储，不再压缩，默认为 :data:`STORE_EXT` 。
+                            使用多个线程时，压缩后没有变小的文件也会直接存储。
+    :param progress: 进度回调函数，参数是一个 :class:`ZipProgress` 。
+                     默认为 :func:`print_progress()` ，传入 None 则不报告进度。
+    :param float progress_interval: 两次调用 progress 之间的最短秒数，
+                                    全部完成后总会再调用一次。
+    :returns: zip 文件的路径；target_file 是没有 name 的文件对象时返回 None 。
     :rtype: str
 
     """
-    zipname = None
-    azip = None
+    owned = None
     if not target_file:
-        azip = tempfile.NamedTemporaryFile(mode='wb', delete=False)
-        zipname = azip.name
+        owned = tempfile.NamedTemporaryFile(mode='wb', delete=False)
+        azip = owned
     else:
         azip = target_file
-        zipname = target_file.name if hasattr(azip, 'read') else azip
-    slog.info('Package %d files to "%s"'%(len(files), azip.name))
-    fileNum = len(files)
-    curFile = 0
+    zipname = azip
+    if hasattr(azip, 'write'):
+        # os.fdopen() 得到的文件对象的 name 是文件描述符
+        zipname = getattr(azip, 'name', None)
+        if not isinstance(zipname, str):
+            zipname = None
+    slog.info('Package %d files to "%s"'%(len(files), zipname))
     zipfile_args['mode'] = 'w'
     if not zipfile_args.get('compression'):
         zipfile_args['compression'] = zipfile.ZIP_DEFLATED
-    with zipfile.ZipFile(azip, **zipfile_args) as zipf:
-       for f in files:
-           percent = round(curFile/fileNum*100)
-           sys.stdout.write('\r%d%%'%(percent))
-           sys.stdout.flush()
-           zipf.write(f, f[trim_arcname:] if trim_arcname else None )
-           curFile = curFile+1
-
-       sys.stdout.write('\r100%\n')
-       sys.stdout.flush()
-
-    if hasattr(azip, 'close'):
-        azip.close()
+    members = ((f, f[trim_arcname:] if trim_arcname else None, None) for f in files)
+    tracker = _Progress(progress, len(files), progress_interval)
+    try:
+        with zipfile.ZipFile(azip, **zipfile_args) as zipf:
+            _write_members(zipf, members, workers, tuple(store_ext or ()), tracker)
+    finally:
+        if owned is not None:
+            owned.close()
+    if hasattr(azip, 'flush') and owned is None:
+        azip.flush()
+    tracker.finish()
     return zipname
 
+def _same_member(info, path, compare):
+    """判断 path 与 zip 中的成员 info 是否相同。"""
+    st = os.stat(path)
+    if info.file_size != st.st_size or info.flag_bits & 0x1:
+        return False
+    if compare == 'crc':
+        crc = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1<<20), b''):
+                crc = zlib.crc32(chunk, crc)
+        return crc == info.CRC
+    # zip 中的时间只精确到 2 秒
+    date_time = time.localtime(st.st_mtime)[0:6]
+    return date_time[0:5] == info.date_time[0:5] and \
+            date_time[5]//2 == info.date_time[5]//2
+
+def _copy_member(zipf, info, raw_file):
+    """将 info 对应的成员的压缩数据从 raw_file 中原样复制到 zipf 中，不解压也不重新压缩。"""
+    raw_file.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+            raw_file.read(zipfile.sizeFileHeader))
+    raw_file.seek(header[zipfile._FH_FILENAME_LENGTH] + \
+            header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.create_system = info.create_system
+    zinfo.external_attr = info.external_attr
+    zinfo.CRC = info.CRC
+    zinfo.file_size = info.file_size
+    # 只保留 LZMA 使用的标志位，大小已经写在文件头中，不再需要数据描述符
+    zinfo.flag_bits = info.flag_bits & 0x02
+    _write_raw(zipf, zinfo, raw_file, info.compress_size)
+
+def update_zip(old_zip, files, trim_arcname=None, target_file=None,
+        compare='mtime+size', workers=None, store_ext=STORE_EXT,
+        progress=print_progress, progress_interval=0.5, **zipfile_args):
+    """根据已有的 zip 文件创建新的 zip 文件，没有改变的文件直接复制压缩后的数据。
+
+    与 :func:`create_zip()` 相同，每个文件都会写入新的 zip 中，顺序与 files 相同；
+    在 old_zip 中存在同名成员且没有改变的文件，直接从 old_zip 中复制压缩后的数据，
+    不解压也不重新压缩，只有新增和改变的文件需要压缩。
+
+    :param str old_zip: 已有的 zip 文件路径，不存在时所有文件都需要压缩。
+    :param list files: 文件列表。
+    :param int trim_arcname: 与 :func:`create_zip()` 相同。
+    :param str target_file: 新的 zip 文件路径。默认为 None ，此时替换 old_zip 。
+                            替换 old_zip 时（包括 target_file 与 old_zip 相同），
+                            先写入临时文件再替换，并保留 old_zip 的权限。
+                            更新失败时不会留下写了一半的文件。
+    :param str compare: 判断文件是否改变的方式。
+                        ``mtime+size`` 比较文件大小和修改时间（zip 中只精确到 2 秒）；
+                        ``crc`` 比较文件大小和 CRC32 ，需要读取文件但不需要压缩。
+    :param int workers: 与 :func:`create_zip()` 相同。
+    :param tuple store_ext: 与 :func:`create_zip()` 相同。
+    :param progress: 与 :func:`create_zip()` 相同。
+    :param float progress_interval: 与 :func:`create_zip()` 相同。
+    :returns: 一个 dict ，包含 reused 、 compressed 、 removed 三个成员名称列表，
+              分别是直接复制的、重新压缩的和 old_zip 中有但 files 中没有的成员。
+    :rtype: dict
+
+    """
+    if compare not in ('mtime+size', 'crc'):
+        raise ValueError('compare must be "mtime+size" or "crc", not %r.'%compare)
+    zipfile_args['mode'] = 'w'
+    if not zipfile_args.get('compression'):
+        zipfile_args['compression'] = zipfile.ZIP_DEFLATED
+    result = {'reused':[], 'compressed':[], 'removed':[]}
+    old_infos = {}
+    raw_file = None
+    if os.path.isfile(old_zip):
+        with zipfile.ZipFile(old_zip) as old:
+            old_infos = {info.filename:info for info in old.infolist()}
+        raw_file = open(old_zip, 'rb')
+    zipname = target_file or old_zip
+    # 写入正在读取的 old_zip 时，先写入同一文件夹中的临时文件，完成后再替换
+    in_place = raw_file is not None and (not target_file or \
+            (os.path.exists(target_file) and os.path.samefile(target_file, old_zip)))
+    try:
+        if in_place:
+            azip = tempfile.NamedTemporaryFile(mode='wb', delete=False,
+                    dir=os.path.dirname(os.path.abspath(zipname)))
+        else:
+            azip = open(zipname, 'wb')
+    except BaseException:
+        if raw_file is not None:
+            raw_file.close()
+        raise
+    slog.info('Update %d files to "%s"'%(len(files), zipname))
+
+    def members():
+        for f in files:
+            arcname = f[trim_arcname:] if trim_arcname else f
+            name = zipfile.ZipInfo.from_file(f, arcname).filename
+            info = old_infos.pop(name, None)
+            if info is not None and not info.is_dir() and \
+                    _same_member(info, f, compare):
+                result['reused'].append(name)
+                yield f, arcname, lambda info=info: _copy_member(zipf, info, raw_file)
+            else:
+                result['compressed'].append(name)
+                yield f, arcname, None
+
+    tracker = _Progress(progress, len(files), progress_interval)
+    try:
+        with azip, zipfile.ZipFile(azip, **zipfile_args) as zipf:
+            _write_members(zipf, members(), workers, tuple(store_ext or ()), tracker)
+        if in_place:
+            os.chmod(azip.name, os.stat(zipname).st_mode & 0o7777)
+            os.replace(azip.name, zipname)
+    except BaseException:
+        # 不保留写了一半的文件
+        if os.path.exists(azip.name):
+            os.remove(azip.name)
+        raise
+    finally:
+        if raw_file is not None:
+            raw_file.close()
+    tracker.finish()
+    result['removed'] = sorted(old_infos)
+    return result
+
+class _MappedFile(object):
+    """在共享的 mmap 上提供独立的读取位置，供 ZipFile 使用。"""
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.buf)
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        end = len(self.buf) if size is None or size < 0 else self.pos + size
+        data = self.buf[self.pos:end]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+def _member_path(dest, name):
+    """与 ZipFile.extract 相同，去掉成员名称中的盘符、 ``.`` 和 ``..`` ，返回解压路径。"""
+    arcname = name.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    parts = [x for x in arcname.split(os.path.sep) \
+            if x not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.join(dest, *parts)
+
+def _same_crc(path, info):
+    """判断 path 的大小和 CRC32 是否与 zip 中的成员 info 相同。"""
+    try:
+        if os.path.getsize(path) != info.file_size:
+            return False
+    except OSError:
+        return False
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc == info.CRC
+
+def extract_zip(path, dest, workers=None, only_changed=True, use_mmap=False,
+        pwd=None):
+    """解压 zip 文件。
+
+    :param str path: zip 文件路径。
+    :param str dest: 解压到这个文件夹。成员名称的处理方式与 ZipFile.extract 相同，
+                     不会写到 dest 之外。
+    :param int workers: 大于 1 时使用这么多线程同时解压，每个线程使用自己的文件句柄。
+    :param bool only_changed: 为 True 时，目标文件的大小和 CRC32 都与成员相同则跳过。
+    :param bool use_mmap: 为 True 时将 zip 文件映射到内存中读取，所有线程共享一个映射。
+    :param bytes pwd: 加密成员的密码。
+    :returns: 一个 dict ，包含 extracted 和 skipped 两个成员名称列表，顺序与 zip 中相同。
+    :rtype: dict
+
+    """
+    mapped = None
+    if use_mmap:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def open_zip():
+        zipf = getattr(local, 'zipf', None)
+        if zipf is None:
+            source = path if mapped is None else _MappedFile(mapped)
+            zipf = local.zipf = zipfile.ZipFile(source)
+            if pwd:
+                zipf.setpassword(pwd)
+            with lock:
+                handles.append(zipf)
+        return zipf
+
+    def extract(info):
+        target = _member_path(dest, info.filename)
+        if info.is_dir():
+            os.makedirs(target, exist_ok=True)
+            return True
+        if only_changed and _same_crc(target, info):
+            return False
+        zipf = open_zip()
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with zipf.open(info) as source, open(target, 'wb') as f:
+            shutil.copyfileobj(source, f, 1<<20)
+        return True
+
+    result = {'extracted':[], 'skipped':[]}
+    try:
+        infos = open_zip().infolist()
+        if workers and workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                done = list(executor.map(extract, infos))
+        else:
+            done = [extract(info) for info in infos]
+    finally:
+        for zipf in handles:
+            zipf.close()
+        if mapped is not None:
+            mapped.close()
+    for info, extracted in zip(infos, done):
+        result['extracted' if extracted else 'skipped'].append(info.filename)
+    slog.info('Extract %d files from "%s" to "%s", skip %d'%(
+        len(result['extracted']), path, dest, len(result['skipped'])))
+    return result
+
 def get_max_ver(fmt, filelist):
     """有一堆字符串，文件名均包含 %d.%d.%d 形式版本号，返回其中版本号最大的那个。
     我一般用它来检测一堆发行版中版本号最大的那个文件。
@@ -14,277 +14,1005 @@
 .. moduleauthor:: zrong(zengrong.net)
 
 """
+import os
 import re
-from rookout.base import read_file
+import pickle
+import hashlib
+import mmap
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from keyword import iskeyword
+from rookout.base import (read_file, get_md5)
 
 ERRORS = {
     'unexp_table': u'Unexpected structure while parsing Lua string.',
     'unexp_end_string': u'Unexpected end of string while parsing Lua string.',
     'unexp_end_table': u'Unexpected end of table while parsing Lua string.',
+    'unexp_token': u'Unexpected token %r while parsing Lua string.',
+    'unexp_type': u'Unexpected type %s while encoding Lua string.',
+    'bad_query': u'Malformed query %r.',
+    'bad_patch': u'Patch paths %r and %r overlap.',
+    'bad_schema': u'Unsupported schema %r.',
+    'bad_value': u'Value %r is not a valid %s.',
+    'unknown_key': u'Unknown key %r while parsing Lua string.',
+    'missing_key': u'Missing key %r while parsing Lua string.',
+    'bad_mode': u'Unknown encode mode %r, must be "pretty", "compact" or "canonical".',
+    'bad_numeric_arrays': u'Unknown numeric_arrays %r, must be None, "list", "array" or "numpy".',
+    'bad_cache': u'numeric_arrays %r conflicts with the cache setting %r.',
+    'cache_schema': u'schema can not be used together with cache.',
     'mfnumber_minus': u'Malformed number (no digits after initial minus).',
     'mfnumber_dec_point': u'Malformed number (no digits after decimal point).',
     'mfnumber_sci': u'Malformed number (bad scientific format).',
 }
 
+# 每次匹配一个完整的 token，前导的空白和注释以及其后的分隔符（, 或 ;）一并吸收。
+# 为了减少循环次数，下面几种情况被合并为一个 token：
+# 只包含数字的 table，例如 {1, 2, 3}；
+# 键名和等号，例如 name = 或 ["name"] = 。
+# 末尾的 \Z 保证文本以注释结束时不会回溯到注释内部，此时得到一个空 token。
+_TOKEN_PATTERN = r"""\s*(?:--(?:%(comment)s|(?!\[=*\[)[^\n]*)\s*)*(?P<tok>
+    \{\s*-?\.?\d(?:[eE][+-]|[\w.])*(?:\s*[,;]\s*-?\.?\d(?:[eE][+-]|[\w.])*)*\s*[,;]?\s*\}
+    |[{}]
+    |[^\W\d]\w*\s*=(?!=)
+    |-?[\w.](?:[eE][+-]|[\w.])*
+    |"[^"\\]*(?:\\.[^"\\]*)*"
+    |'[^'\\]*(?:\\.[^'\\]*)*'
+    |\[\s*(?:"[^"\\]*(?:\\.[^"\\]*)*"|'[^'\\]*(?:\\.[^'\\]*)*'|[\w.+-]+)\s*\]\s*=(?!=)
+    |%(string)s
+    |\S
+    |\Z
+    )\s*[,;]?"""
+
+# 大多数文件不使用带等号的长括号 [==[ ]==]，此时使用只有一个分组的表达式，
+# findall 直接返回字符串列表；否则需要用反向引用匹配等号的数量。
+_TOKEN = re.compile(_TOKEN_PATTERN % {
+    'comment': r'\[\[.*?\]\]',
+    'string': r'\[\[.*?\]\]',
+    }, re.X | re.S)
+_TOKEN_LEVELS = re.compile(_TOKEN_PATTERN % {
+    'comment': r'\[(?P<ceq>=*)\[.*?\](?P=ceq)\]',
+    'string': r'\[(?P<seq>=*)\[.*?\](?P=seq)\]',
+    }, re.X | re.S)
+
+def _bytes_pattern(pattern):
+    """生成用于 decode_bytes() 的 bytes 版本，匹配的结果同样是完整的 token 。
+
+    bytes 中的 \\w 只匹配 ASCII 字符，这里把所有 >= 0x80 的字节也当作名称中的字符，
+    这样 UTF-8 编码的非 ASCII 键名（例如 ``{名字 = 1}``）与 :func:`decode()` 一样可以解析。
+    """
+    pattern = pattern.replace(r'[^\W\d]\w*', r'(?:[^\W\d]|[\x80-\xff])[\w\x80-\xff]*')
+    pattern = pattern.replace(r'[\w.', r'[\w\x80-\xff.')
+    return re.compile(pattern.encode('ascii'), re.X | re.S)
+
+_TOKEN_BYTES = _bytes_pattern(_TOKEN.pattern)
+_TOKEN_LEVELS_BYTES = _bytes_pattern(_TOKEN_LEVELS.pattern)
+_LEVEL_BYTES = re.compile(br'\[=')
+
+_NUMBER_START = frozenset('-.0123456789')
+_NOKEY = object()
+
+# compact 模式下可以不加方括号和引号直接作为键名的字符串。
+_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+_KEYWORDS = frozenset(('and', 'break', 'do', 'else', 'elseif', 'end',
+    'false', 'for', 'function', 'goto', 'if', 'in', 'local', 'nil', 'not',
+    'or', 'repeat', 'return', 'then', 'true', 'until', 'while'))
+_MODES = ('pretty', 'compact', 'canonical')
+
+# 跳过一个 table 时只需要找到配对的花括号，
+# 不包含花括号、引号、注释和长括号的连续字符作为一个整体匹配。
+_SKIP = re.compile(r"""[^{}"'\[\-]+
+    |"[^"\\]*(?:\\.[^"\\]*)*"
+    |'[^'\\]*(?:\\.[^'\\]*)*'
+    |--(?:\[(?P<ceq>=*)\[.*?\](?P=ceq)\]|(?!\[=*\[)[^\n]*)
+    |\[(?P<seq>=*)\[.*?\](?P=seq)\]
+    |.""", re.X | re.S)
+
+# 流式读取时，这些单字符 token 说明字符串或注释尚未读取完整。
+_UNFINISHED = frozenset(('"', "'", '[', '-'))
+
+
+def _tokenize(text):
+    """将 lua 源码切分成 token 列表，注释在切分的同时被跳过。
+
+    text 也可以是 bytes 、 memoryview 或 mmap ，此时得到的是 bytes 的 token 列表。
+    """
+    if type(text) is str:
+        if '[=' in text:
+            tokens = [t[1] for t in _TOKEN_LEVELS.findall(text)]
+        else:
+            tokens = _TOKEN.findall(text)
+    elif _LEVEL_BYTES.search(text):
+        tokens = [t[1] for t in _TOKEN_LEVELS_BYTES.findall(text)]
+    else:
+        tokens = _TOKEN_BYTES.findall(text)
+    while tokens and not tokens[-1]:
+        tokens.pop()
+    return tokens
+
+def _number(tok):
+    if '.' in tok:
+        return float(tok)
+    try:
+        return int(tok)
+    except ValueError:
+        pass
+    if tok[:2] in ('0x', '0X') or tok[:3] in ('-0x', '-0X'):
+        return int(tok, 16)
+    return float(tok)
+
+def _number_parts(tok):
+    """将只包含数字的 table token 拆分成数字字符串列表。"""
+    body = tok[1:-1]
+    if ';' in body:
+        body = body.replace(';', ',')
+    parts = body.split(',')
+    if not parts[-1].strip():
+        parts.pop()
+    return parts
+
+def _number_list(tok):
+    parts = _number_parts(tok)
+    try:
+        return list(map(int, parts))
+    except ValueError:
+        return [_number(p.strip()) for p in parts]
+
+def _number_array(tok):
+    """与 _number_list 相同，但直接生成 array.array 。"""
+    parts = _number_parts(tok)
+    try:
+        return array('q', map(int, parts))
+    except ValueError:
+        pass
+    except OverflowError:
+        return _number_list(tok)
+    return _to_array([_number(p.strip()) for p in parts])
+
+def _to_array(values):
+    """values 中全部是 int 或全部是 float 时转换成 array.array ，否则原样返回。"""
+    if not values:
+        return values
+    tp = type(values[0])
+    if tp is not int and tp is not float:
+        return values
+    for v in values:
+        if type(v) is not tp:
+            return values
+    try:
+        return array('q' if tp is int else 'd', values)
+    except OverflowError:
+        return values
+
+def _to_ndarray(values):
+    """与 _to_array 相同，但返回 numpy.ndarray ，共享 array.array 的内存。"""
+    import numpy
+    if type(values) is not array:
+        values = _to_array(values)
+        if type(values) is not array:
+            return values
+    return numpy.frombuffer(values, values.typecode == 'q' and 'int64' or 'float64')
+
+def _numeric_arrays(mode):
+    """返回 numeric_arrays 参数对应的两个转换函数：
+    一个用于只包含数字的 table token ，一个用于解析完成的 list 。
+    """
+    if mode is None or mode == 'list':
+        return _number_list, None
+    if mode == 'array':
+        return _number_array, _to_array
+    if mode == 'numpy':
+        # 没有安装 numpy 时在解析之前就抛出 ImportError
+        import numpy
+        return lambda tok: _to_ndarray(_number_array(tok)), _to_ndarray
+    raise TypeError(ERRORS['bad_numeric_arrays'] % (mode,))
+
+def _scalar(tok):
+    c = tok[0]
+    if c in _NUMBER_START:
+        return _number(tok)
+    if c == '"' or c == "'":
+        return _string(tok)
+    return _word(tok)
+
+def _string(tok):
+    q = tok[0]
+    if len(tok) < 2 or tok[-1] != q:
+        raise TypeError(ERRORS['unexp_end_string'])
+    s = tok[1:-1]
+    if '\\' in s:
+        return s.replace('\\' + q, q)
+    return s
+
+def _long_string(tok):
+    """长字符串 [[ ]] 或 [==[ ]==]，紧跟在开始括号后的换行会被忽略。"""
+    n = tok.index('[', 1) + 1
+    s = tok[n:-n]
+    if s[:1] == '\n':
+        return s[1:]
+    if s[:2] == '\r\n':
+        return s[2:]
+    return s
+
+def _key(tok):
+    """从 ``name =`` 或 ``[key] =`` 形式的 token 中取出键。"""
+    if tok[0] == '[':
+        return _scalar(tok[1:tok.rindex(']')].strip())
+    return tok[:-1].rstrip()
+
+def _table(arr, hsh):
+    """生成 table 对应的 python 对象。
+
+    解析时顺序值直接追加到 arr 中，键值对放在 hsh 中（没有键值对时为 None）。
+    只包含顺序值的 table 就是 list，末尾的 nil 被丢弃；
+    包含键值对的 table 是 dict，顺序值使用从 0 开始的整数作为键，只合并一次。
+    空 table 是 dict。
+    """
+    if hsh is None:
+        if not arr:
+            return {}
+        while arr and arr[-1] is None:
+            arr.pop()
+        return arr
+    if arr:
+        o = dict(enumerate(arr))
+        o.update(hsh)
+        return o
+    return hsh
+
+def _flat(obj):
+    """只包含数字和短字符串的 list 在一行中输出。
+    检查元素类型的同时生成输出，遇到其他类型时返回 None 。
+    """
+    out = []
+    for v in obj:
+        tp = type(v)
+        if tp is int or tp is float:
+            out.append(str(v))
+        elif tp is str and len(v) < 10:
+            out.append('"%s"' % v.replace('"', '\\"'))
+        else:
+            return None
+    return '{%s}' % ','.join(out)
+
+def _sort_key(item):
+    """canonical 模式下键的排序规则：数字在前，字符串在后，其他类型按 repr 排序。"""
+    k = item[0]
+    tp = type(k)
+    if tp is int or tp is float or tp is bool:
+        return (0, k, '')
+    if tp is str:
+        return (1, 0, k)
+    return (2, 0, repr(k))
+
+def _word(tok):
+    lower = tok.lower()
+    if lower == 'true':
+        return True
+    elif lower == 'false':
+        return False
+    elif tok == 'nil':
+        return None
+    return tok
+
 
 class Lua:
-    """进行 lua 标准 table 和 python 数据之间的转换。使用 python re 模块进行解析。"""
+    """进行 lua 标准 table 和 python 数据之间的转换。
+
+    使用一个预编译的正则表达式一次性切分出所有 token（字符串、数字、名称和标点），
+    然后用一个显式的栈构建 python 对象，不再逐个字符扫描，也不使用递归。
+
+    解析和转换的状态都保存在每次调用的局部变量中，实例只保存输出格式的设置，
+    因此同一个实例可以在多个线程中同时使用。
+    """
 
     def __init__(self):
-        self.text = ''
-        self.ch = ''
-        self.at = 0
-        self.len = 0
-        self.depth = 0
-        self.space = re.compile('\s', re.M)
-        self.alnum = re.compile('\w', re.M)
         self.newline = '\n'
         self.tab = '\t'
 
-    def decode(self, text):
+    def decode(self, text, numeric_arrays=None, schema=None):
         if not text or type(text) is not str:
             return
-        #FIXME: only short comments removed
-        reg = re.compile('--.*$', re.M)
-        text = reg.sub('', text, 0)
-        tstart = text.find('{')
-        tend = text.rfind('}')
-        if tstart < 0 and tend < 0:
-            self.text = text
-        elif tstart < 0 or tend < 0:
-            raise TypeError(ERRORS['unexp_table'])
-        else:
-            self.text = text[tstart:tend+1]
-        self.at, self.ch, self.depth = 0, '', 0
-        self.len = len(self.text)
-        self.next_chr()
-        result = self.value()
-        return result
-
-    def encode(self, obj):
-        if not obj:
+        return self._decode_tokens(_tokenize(text), numeric_arrays, schema)
+
+    def decode_bytes(self, buf, numeric_arrays=None, schema=None):
+        """与 :meth:`decode()` 相同，但直接解析 UTF-8 编码的 bytes 、
+        memoryview 或 mmap ，不需要先把整个文件转换成 str 。
+        只有切分出来的 token 才会被解码。
+        """
+        if not buf:
             return
-        self.depth = 0
-        return self.__encode(obj)
-
-    def __encode(self, obj):
-        s = ''
-        tab = self.tab
-        newline = self.newline
-        tp = type(obj)
-        if tp is str:
-            s += '"%s"' % obj.replace(r'"', r'\"')
-        elif tp in [int, float, complex]:
-            s += str(obj)
-        elif tp is bool:
-            s += str(obj).lower()
-        elif tp in [list, tuple, dict]:
-            self.depth += 1
-            if len(obj) == 0 or ( tp is not dict and len(list(filter(
-                    lambda x:  type(x) in (int,  float) \
-                    or (type(x) is str and len(x) < 10),  obj
-                ))) == len(obj) ):
-                newline = tab = ''
-            dp = tab * self.depth
-            s += "%s{%s" % (tab * (self.depth - 2), newline)
-            if tp is dict:
-                s += (',%s' % newline).join(
-                    [self.__encode(v) if type(k) is int \
-                        else dp + '["%s"] = %s' % (k, self.__encode(v)) \
-                        for k, v in obj.items()
-                    ])
+        return self._decode_tokens(map(bytes.decode, _tokenize(buf)),
+                numeric_arrays, schema)
+
+    def _decode_tokens(self, tokens, numeric_arrays, schema):
+        # 跳过第一个 table 之前的内容，例如 local data = 。
+        it = iter(tokens)
+        tok = _skip_to_table(it)
+        if tok is not None:
+            tokens = chain((tok,), it)
+        if schema is not None and not isinstance(schema, Schema):
+            schema = Schema(schema)
+        try:
+            if schema is not None:
+                return schema._parse(tokens)
+            return self.parse(tokens, numeric_arrays)
+        except _CallError as e:
+            raise e.error from None
+        except ValueError:
+            # 包括 decode_bytes() 中的 UnicodeDecodeError
+            raise TypeError(ERRORS['unexp_table'])
+
+    def parse(self, tokens, numeric_arrays=None):
+        """将 token 列表转换成 python 对象。
+
+        :param list tokens: 由 ``_tokenize()`` 得到的 token 列表，也可以是迭代器。
+                            解析完第一个值后即返回，迭代器中剩余的 token 不会被读取。
+        :param str numeric_arrays: 只包含数字的 table 的保存方式，
+                                   参见 :func:`rookout.lua.decode()` 。
+        :return: python 对象
+        :raise: :class:`TypeError`
+
+        """
+        number_list, to_array = _numeric_arrays(numeric_arrays)
+        stack = []
+        arr, hsh, key = None, None, _NOKEY
+        for tok in tokens:
+            c = tok[0]
+            if c == '{':
+                if len(tok) > 1:
+                    v = number_list(tok)
+                else:
+                    stack.append((arr, hsh, key))
+                    arr, hsh, key = [], None, _NOKEY
+                    continue
+            elif c == '}':
+                if not stack or key is not _NOKEY:
+                    raise TypeError(ERRORS['unexp_token'] % tok)
+                v = _table(arr, hsh)
+                if to_array is not None and type(v) is list:
+                    v = to_array(v)
+                arr, hsh, key = stack.pop()
+            elif c in _NUMBER_START:
+                v = _number(tok)
+            elif c == '"' or c == "'":
+                if len(tok) < 2 or tok[-1] != c:
+                    raise TypeError(ERRORS['unexp_end_string'])
+                v = tok[1:-1]
+                if '\\' in v:
+                    v = v.replace('\\' + c, c)
+            elif tok[-1] == '=' and len(tok) > 1:
+                # 单独的 = 不是键名，由最后的 else 抛出异常
+                if arr is None or key is not _NOKEY:
+                    raise TypeError(ERRORS['unexp_token'] % tok)
+                if c == '[':
+                    q = tok[1]
+                    if q == '"' or q == "'":
+                        key = tok[2:tok.rindex(q)]
+                        if '\\' in key:
+                            key = key.replace('\\' + q, q)
+                    else:
+                        key = _key(tok)
+                else:
+                    key = tok[:-1].rstrip()
+                continue
+            elif c == '[' and len(tok) > 1:
+                v = _long_string(tok)
+            elif c.isalpha() or c == '_':
+                v = _word(tok)
+            elif c == ',' or c == ';':
+                # 分隔符之前有注释时，分隔符会成为单独的 token
+                continue
             else:
-                s += (',%s' % newline).join(
-                    [dp + self.__encode(el) for el in obj])
-            self.depth -= 1
-            s += "%s%s}" % (newline, tab * self.depth)
-        return s
-
-    def white(self):
-        while self.ch:
-            if self.space.match(self.ch):
-                self.next_chr()
+                raise TypeError(ERRORS['unexp_token'] % tok)
+            if arr is None:
+                return v
+            if key is _NOKEY:
+                arr.append(v)
             else:
-                break
-
-    def next_chr(self):
-        if self.at >= self.len:
-            self.ch = None
-            return None
-        self.ch = self.text[self.at]
-        self.at += 1
-        return True
+                if hsh is None:
+                    hsh = {}
+                hsh[key] = v
+                key = _NOKEY
+        if stack:
+            raise TypeError(ERRORS['unexp_end_table'])
 
-    def value(self):
-        self.white()
-        if not self.ch:
+    def encode(self, obj, mode='pretty'):
+        # numpy.ndarray 不能直接判断真假，array.array 和 ndarray 只在为空时返回 None
+        if type(obj) is array:
+            if not len(obj):
+                return
+        elif hasattr(obj, 'tolist') and hasattr(obj, 'dtype'):
+            if not obj.size:
+                return
+        elif not obj:
             return
-        if self.ch == '{':
-            return self.object()
-        if self.ch == "[":
-            self.next_chr()
-        if self.ch in ['"',  "'",  '[']:
-            return self.string(self.ch)
-        if self.ch.isdigit() or self.ch == '-':
-            return self.number()
-        return self.word()
-
-    def string(self, end=None):
-        s = ''
-        start = self.ch
-        if end == '[':
-            end = ']'
-        if start in ['"',  "'",  '[']:
-            while self.next_chr():
-                if self.ch == end:
-                    self.next_chr()
-                    if start != "[" or self.ch == ']':
-                        return s
-                if self.ch == '\\' and start == end:
-                    self.next_chr()
-                    if self.ch != end:
-                        s += '\\'
-                s += self.ch
-        slog.error(ERRORS['unexp_end_string'])
-
-    def object(self):
-        o = {}
-        k = ''
-        idx = 0
-        numeric_keys = False
-        self.depth += 1
-        self.next_chr()
-        self.white()
-        if self.ch and self.ch == '}':
-            self.depth -= 1
-            self.next_chr()
-            return o #Exit here
+        out = []
+        self.dump(obj, out.append, 0, mode)
+        return ''.join(out)
+
+    def dump(self, obj, write, bufsize=1024, mode='pretty'):
+        """将 python 对象转换成 lua 格式，分段调用 write 写出。
+
+        输出片段先累积在一个列表中，每 bufsize 个片段合并后调用一次 write，
+        bufsize 为 0 时每个片段都直接写出。
+        每一层的缩进字符串只生成一次。
+
+        :param object obj: 一个 python 对象。
+        :param function write: 接受一个字符串参数的写入函数，例如 file.write 。
+        :param int bufsize: 合并写出的片段数量。
+        :param str mode: 输出格式，参见 :func:`rookout.lua.encode()` 。
+        :raise: :class:`TypeError`
+
+        """
+        if mode not in _MODES:
+            raise TypeError(ERRORS['bad_mode'] % (mode,))
+        if mode == 'compact':
+            tab, newline, eq = '', '', '='
         else:
-            while self.ch:
-                self.white()
-                if self.ch == '{':
-                    o[idx] = self.object()
-                    idx += 1
-                    continue
-                elif self.ch == '}':
-                    self.depth -= 1
-                    self.next_chr()
-                    if k:
-                       o[idx] = k
-                    if not numeric_keys and len([ key for key in o if type(key) in (str,  float,  bool,  tuple)]) == 0:
-                        ar = []
-                        for key in o:
-                           ar.insert(key, o[key])
-                        o = ar
-                    return o #or here
+            tab, newline, eq = self.tab, self.newline, ' = '
+        names = mode == 'compact'
+        ordered = mode == 'canonical'
+        indents = [newline]
+        parts = []
+        if bufsize:
+            append = parts.append
+        else:
+            append = write
+
+        def _dump(obj, depth):
+            tp = type(obj)
+            if tp is str:
+                append('"%s"' % obj.replace('"', '\\"'))
+            elif tp is int or tp is float or tp is complex:
+                append(str(obj))
+            elif tp is bool:
+                append('true' if obj else 'false')
+            elif obj is None:
+                append('nil')
+            elif tp is list or tp is tuple or tp is dict:
+                if not obj:
+                    flat = '{}'
+                elif tp is dict:
+                    flat = None
+                else:
+                    flat = _flat(obj)
+                if flat is not None:
+                    append(flat)
                 else:
-                    if self.ch == ',':
-                        self.next_chr()
-                        continue
+                    depth += 1
+                    if depth >= len(indents):
+                        indents.append(newline + tab * depth)
+                    inner = indents[depth]
+                    sep = ',' + inner
+                    append('{')
+                    if tp is dict:
+                        # 解析时顺序值的键是从 0 开始的整数，
+                        # 这些键按顺序写成顺序值，lua 中的位置才与解析前相同
+                        n = 0
+                        while n in obj:
+                            n += 1
+                        items = obj.items()
+                        if n:
+                            for i in range(n):
+                                append(inner)
+                                inner = sep
+                                _dump(obj[i], depth)
+                            index = range(n)
+                            items = [(k, v) for k, v in items \
+                                    if type(k) is str or k not in index]
+                        if ordered:
+                            items = sorted(items, key=_sort_key)
+                        for k, v in items:
+                            append(inner)
+                            inner = sep
+                            if type(k) is str:
+                                if names and _NAME.match(k) and k not in _KEYWORDS:
+                                    append(k + eq)
+                                else:
+                                    append('["%s"]%s' % (k.replace('"', '\\"'), eq))
+                            else:
+                                append('[')
+                                _dump(k, depth)
+                                append(']' + eq)
+                            _dump(v, depth)
                     else:
-                        k = self.value()
-                        if self.ch == ']':
-                            numeric_keys = True
-                            self.next_chr()
-                    self.white()
-                    if self.ch == '=':
-                        self.next_chr()
-                        self.white()
-                        o[k] = self.value()
-                        idx += 1
-                        k = ''
-                    elif self.ch == ',':
-                        self.next_chr()
-                        self.white()
-                        o[idx] = k
-                        idx += 1
-                        k = ''
-        slog.error(ERRORS['unexp_end_table']) #Bad exit here
-
-    def word(self):
-        s = ''
-        if self.ch != '\n':
-          s = self.ch
-        while self.next_chr():
-            if self.alnum.match(self.ch):
-                s += self.ch
+                        for v in obj:
+                            append(inner)
+                            inner = sep
+                            _dump(v, depth)
+                    append(indents[depth - 1])
+                    append('}')
+            elif tp is array:
+                append('{%s}' % ','.join(map(str, obj)))
+            elif hasattr(obj, 'tolist') and hasattr(obj, 'dtype'):
+                # numpy.ndarray 和 numpy 的标量类型，不需要导入 numpy
+                if getattr(obj, 'ndim', 0) == 1 and obj.dtype.kind in 'iuf':
+                    append('{%s}' % ','.join(map(str, obj.tolist())))
+                else:
+                    _dump(obj.tolist(), depth)
             else:
-                if re.match('^true$', s, re.I):
-                    return True
-                elif re.match('^false$', s, re.I):
-                    return False
-                elif s == 'nil':
-                    return None
-                return str(s)
-
-    def number(self):
-        def next_digit(err):
-            n = self.ch
-            self.next_chr()
-            if not self.ch or not self.ch.isdigit():
-                raise TypeError(err)
-            return n
-        n = ''
+                raise TypeError(ERRORS['unexp_type'] % tp.__name__)
+            if bufsize and len(parts) >= bufsize:
+                write(''.join(parts))
+                parts.clear()
+
+        _dump(obj, 0)
+        if parts:
+            write(''.join(parts))
+
+
+lua = Lua()
+"""一个默认的 lua 模块"""
+
+def _to_int(v):
+    tp = type(v)
+    if tp is int:
+        return v
+    if tp is float and v.is_integer():
+        return int(v)
+    if tp is str:
         try:
-            if self.ch == '-':
-                n += next_digit(ERRORS['mfnumber_minus'])
-            n += self.digit()
-            if n == '0' and self.ch in ['x', 'X']:
-                n += self.ch
-                self.next_chr()
-                n += self.hex()
-            else:
-                if self.ch and self.ch == '.':
-                    n += next_digit(ERRORS['mfnumber_dec_point'])
-                    n += self.digit()
-                if self.ch and self.ch in ['e', 'E']:
-                    n += self.ch
-                    self.next_chr()
-                    if not self.ch or self.ch not in ('+', '-'):
-                        raise TypeError(ERRORS['mfnumber_sci'])
-                    n += next_digit(ERRORS['mfnumber_sci'])
-                    n += self.digit()
-        except TypeError as e:
-            slog.error(e)
-            return 0
+            n = _number(v.strip())
+        except ValueError:
+            pass
+        else:
+            if type(n) is int:
+                return n
+            if n.is_integer():
+                return int(n)
+    raise TypeError(ERRORS['bad_value'] % (v, 'int'))
+
+def _to_float(v):
+    tp = type(v)
+    if tp is float:
+        return v
+    if tp is int:
+        return float(v)
+    if tp is str:
         try:
-            return int(n, 0)
-        except:
+            return float(v)
+        except ValueError:
             pass
-        return float(n)
+    raise TypeError(ERRORS['bad_value'] % (v, 'float'))
 
-    def digit(self):
-        n = ''
-        while self.ch and self.ch.isdigit():
-            n += self.ch
-            self.next_chr()
-        return n
+def _to_str(v):
+    tp = type(v)
+    if tp is str:
+        return v
+    if tp is int or tp is float:
+        return str(v)
+    raise TypeError(ERRORS['bad_value'] % (v, 'str'))
 
-    def hex(self):
-        n = ''
-        while self.ch and \
-            (self.ch in 'ABCDEFabcdef' or self.ch.isdigit()):
-            n += self.ch
-            self.next_chr()
-        return n
+def _to_bool(v):
+    if type(v) is bool:
+        return v
+    raise TypeError(ERRORS['bad_value'] % (v, 'bool'))
 
+_COERCE = {int: _to_int, float: _to_float, str: _to_str, bool: _to_bool}
 
-lua = Lua()
-"""一个默认的 lua 模块"""
+def _not_scalar(v):
+    if v is None:
+        return v
+    raise TypeError(ERRORS['bad_value'] % (v, 'table'))
+
+def _no_value(v):
+    raise TypeError(ERRORS['unexp_table'])
+
+class _CallError(Exception):
+    """包装 schema 中可调用对象抛出的 ValueError ，使它不会被当作格式错误。"""
+
+    def __init__(self, error):
+        Exception.__init__(self, error)
+        self.error = error
+
+def _call(spec):
+    def call(v):
+        try:
+            return spec(v)
+        except ValueError as e:
+            raise _CallError(e)
+    return call
+
+# 编译后的 schema 节点的种类，小于 _ANYTHING 的节点不能是 table
+_NOVALUE, _SCALAR, _ANYTHING, _CALL, _LIST, _MAP, _RECORD = range(7)
+
+
+class _Node:
+    """编译后的 schema 节点。
+
+    scalar 用于转换标量值，为 None 时不转换；
+    item 是顺序值对应的节点，fields 是记录中每个键对应的节点，
+    解析时直接查找，不需要为每个值调用方法。
+    """
+    __slots__ = ('kind', 'scalar', 'item', 'fields', 'key', 'required', 'factory')
+
+    def __init__(self, kind, scalar=None, item=None):
+        self.kind = kind
+        self.scalar = scalar
+        self.item = item
+        self.fields = None
+        self.key = None
+        self.required = None
+        self.factory = None
+
+    def bulk(self, tok):
+        """转换只包含数字的 table token 。"""
+        if self.kind < _ANYTHING:
+            raise TypeError(ERRORS['unexp_token'] % tok)
+        values = _number_list(tok)
+        if self.kind == _LIST or self.kind == _MAP:
+            scalar = self.item.scalar
+            if scalar is not None:
+                values = list(map(scalar, values))
+        return self.build(values, None)
+
+    def build(self, arr, hsh):
+        """生成 table 对应的 python 对象，其中的值已经转换过了。"""
+        kind = self.kind
+        if kind == _LIST:
+            if hsh is not None:
+                raise TypeError(ERRORS['unknown_key'] % next(iter(hsh)))
+            while arr and arr[-1] is None:
+                arr.pop()
+            return arr
+        if kind == _RECORD:
+            if arr:
+                raise TypeError(ERRORS['unexp_table'])
+            if hsh is None:
+                hsh = {}
+            if not self.required.issubset(hsh):
+                missing = sorted(self.required.difference(hsh))[0]
+                raise TypeError(ERRORS['missing_key'] % missing)
+            if self.factory is None:
+                return hsh
+            return self.factory(*map(hsh.get, self.fields))
+        if kind == _MAP:
+            if arr:
+                o = dict(zip(map(self.key, range(len(arr))), arr))
+                if hsh:
+                    o.update(hsh)
+                return o
+            return hsh if hsh is not None else {}
+        o = _table(arr, hsh)
+        if kind == _CALL:
+            return self.scalar(o)
+        return o
+
+_ANY_NODE = _Node(_ANYTHING)
+_ANY_NODE.item = _ANY_NODE
+_NO_VALUE = _Node(_NOVALUE, _no_value)
+
+def _type_name(key):
+    """根据键名生成记录类的名称，例如 sprite_frames 对应 SpriteFrames 。"""
+    if type(key) is str and _NAME.match(key):
+        name = ''.join(part[:1].upper() + part[1:] for part in key.split('_'))
+        if name and name[0].isalpha():
+            return name
+    return 'Record'
+
+def _compile(spec, name):
+    if spec is None or spec is object:
+        return _ANY_NODE
+    if type(spec) is type and spec in _COERCE:
+        return _Node(_SCALAR, _COERCE[spec])
+    if type(spec) is list:
+        if len(spec) != 1:
+            raise TypeError(ERRORS['bad_schema'] % (spec,))
+        return _Node(_LIST, _not_scalar, _compile(spec[0], name))
+    if type(spec) is dict:
+        if len(spec) == 1:
+            key_spec = next(iter(spec))
+            if key_spec in _COERCE:
+                node = _Node(_MAP, _not_scalar, _compile(spec[key_spec], name))
+                node.key = _COERCE[key_spec]
+                return node
+        node = _Node(_RECORD, _not_scalar, _NO_VALUE)
+        node.fields = {}
+        required = []
+        for key, value in spec.items():
+            if type(key) is not str:
+                raise TypeError(ERRORS['bad_schema'] % (key,))
+            if key.endswith('?'):
+                key = key[:-1]
+            else:
+                required.append(key)
+            node.fields[key] = _compile(value, _type_name(key))
+        node.required = frozenset(required)
+        fields = list(node.fields)
+        if all(_NAME.match(k) and k[0] != '_' and not iskeyword(k) \
+                for k in fields):
+            node.factory = namedtuple(name, fields)
+        return node
+    if callable(spec):
+        return _Node(_CALL, _call(spec), _ANY_NODE)
+    raise TypeError(ERRORS['bad_schema'] % (spec,))
+
+
+class Schema:
+    """编译后的 lua table 结构描述，解析的同时转换和检查每一个值。
+
+    spec 的写法：
+
+    - ``int`` 、 ``float`` 、 ``str`` 、 ``bool`` ：标量值，
+      数字和数字字符串可以互相转换，整数值的浮点数可以转换成 int；
+    - ``None`` 或 ``object`` ：任意值，不做检查；
+    - ``[spec]`` ：顺序元素的值都符合 spec 的 list；
+    - ``{str: spec}`` 或 ``{int: spec}`` ：键为字符串或整数、值符合 spec 的 dict；
+    - ``{'key': spec, 'key2?': spec, ...}`` ：记录，只能包含这些键，
+      以 ? 结尾的键可以省略，省略时值为 None 。
+      键都是合法的 python 标识符（不是关键字）时，记录解析成 :func:`collections.namedtuple` 生成的类的实例，
+      同一个 spec 的所有记录共享一个类，不需要为每个记录创建 dict；否则解析成 dict ；
+    - 其他可调用对象：值先按照 :func:`decode()` 的规则解析，然后调用 ``spec(value)`` 。
+
+    不符合 spec 的值和未知的键在解析到的时候立即抛出 :class:`TypeError` ，
+    不必等到整个文件解析完成。
+
+    >>> schema = lua.Schema({'name': str, 'range': [int], 'loops?': int})
+    >>> lua.decode('{name = "a", range = {1, 2.0}}', schema=schema)
+    Record(name='a', range=[1, 2], loops=None)
+
+    :param spec: 结构描述。
+    :raise: :class:`TypeError`
+
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.root = _compile(spec, 'Record')
+
+    def decode(self, text):
+        """与 :func:`decode()` 相同，使用这个 schema 解析。"""
+        return lua.decode(text, schema=self)
+
+    def decode_file(self, luafile, mmap=False):
+        """与 :func:`decode_file()` 相同，使用这个 schema 解析。"""
+        return decode_file(luafile, mmap=mmap, schema=self)
+
+    def parse(self, tokens):
+        """与 :meth:`Lua.parse()` 相同，但按照 schema 转换和检查每一个值。"""
+        try:
+            return self._parse(tokens)
+        except _CallError as e:
+            raise e.error from None
+
+    def _parse(self, tokens):
+        stack = []
+        arr, hsh, key = None, None, _NOKEY
+        # node 是当前 table 的节点，vnode 是下一个值的节点
+        node, vnode, item, fields = None, self.root, None, None
+        for tok in tokens:
+            c = tok[0]
+            if c == '{':
+                if len(tok) > 1:
+                    v = vnode.bulk(tok)
+                else:
+                    if vnode.kind < _ANYTHING:
+                        raise TypeError(ERRORS['unexp_token'] % tok)
+                    stack.append((arr, hsh, key, node))
+                    arr, hsh, key, node = [], None, _NOKEY, vnode
+                    vnode = item = node.item
+                    fields = node.fields
+                    continue
+            elif c == '}':
+                if not stack or key is not _NOKEY:
+                    raise TypeError(ERRORS['unexp_token'] % tok)
+                v = node.build(arr, hsh)
+                arr, hsh, key, node = stack.pop()
+                if node is not None:
+                    item, fields = node.item, node.fields
+            elif c in _NUMBER_START:
+                v = _number(tok)
+                if vnode.scalar is not None:
+                    v = vnode.scalar(v)
+            elif c == '"' or c == "'":
+                v = _string(tok)
+                if vnode.scalar is not None:
+                    v = vnode.scalar(v)
+            elif tok[-1] == '=' and len(tok) > 1:
+                if arr is None or key is not _NOKEY:
+                    raise TypeError(ERRORS['unexp_token'] % tok)
+                key = _key(tok) if c == '[' else tok[:-1].rstrip()
+                # 未知的键在读到键名时就抛出异常，不必解析它的值
+                if fields is not None:
+                    vnode = fields.get(key)
+                    if vnode is None:
+                        raise TypeError(ERRORS['unknown_key'] % key)
+                elif node.kind == _MAP:
+                    key = node.key(key)
+                elif node.kind == _LIST:
+                    raise TypeError(ERRORS['unknown_key'] % key)
+                continue
+            elif c == '[' and len(tok) > 1:
+                v = _long_string(tok)
+                if vnode.scalar is not None:
+                    v = vnode.scalar(v)
+            elif c.isalpha() or c == '_':
+                v = _word(tok)
+                if v is not None:
+                    if vnode.scalar is not None:
+                        v = vnode.scalar(v)
+                elif fields is not None and key is not _NOKEY:
+                    # 与 lua 相同，记录中值为 nil 的键等同于不存在
+                    key = _NOKEY
+                    vnode = item
+                    continue
+            elif c == ',' or c == ';':
+                continue
+            else:
+                raise TypeError(ERRORS['unexp_token'] % tok)
+            if arr is None:
+                return v
+            if key is _NOKEY:
+                arr.append(v)
+            else:
+                if hsh is None:
+                    hsh = {}
+                hsh[key] = v
+                key = _NOKEY
+            vnode = item
+        if stack:
+            raise TypeError(ERRORS['unexp_end_table'])
+
+
+class DecodeCache:
+    """:func:`decode_file()` 的缓存。
+
+    在内存中保存最近使用的 maxsize 个解析结果；提供 cache_dir 时，
+    解析结果还会以 pickle 格式保存在磁盘上，下次运行时直接载入而不必重新解析。
+
+    缓存以文件的绝对路径为键，使用文件大小和修改时间判断文件是否改变，
+    use_md5 为 True 时还会比较文件的 MD5 值。
+    numeric_arrays 不同的缓存使用不同的磁盘缓存文件，可以共享一个 cache_dir 。
+
+    返回的对象会被多次调用共享，如果要修改它，请先复制一份。
+
+    :param int maxsize: 内存中最多保存的解析结果数量。
+    :param str cache_dir: 磁盘缓存所在的文件夹，为 None 时不使用磁盘缓存。
+    :param bool use_md5: 是否使用 MD5 值判断文件是否改变。
+    :param str numeric_arrays: 传递给 :func:`rookout.lua.decode()` 。
+
+    """
+
+    def __init__(self, maxsize=128, cache_dir=None, use_md5=False,
+            numeric_arrays=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.use_md5 = use_md5
+        self.numeric_arrays = numeric_arrays
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def decode_file(self, luafile, mmap=False):
+        """与 :func:`rookout.lua.decode_file()` 相同，但优先使用缓存。
+
+        :param str luafile: lua文件路径。
+        :param bool mmap: 需要解析时是否将文件映射到内存，参见 :func:`rookout.lua.decode_file()` 。
+        :return: python 对象
+        :raise: :class:`TypeError`
+
+        """
+        path = os.path.abspath(luafile)
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime_ns)
+        if self.use_md5:
+            stamp += (get_md5(path),)
+        with self._lock:
+            item = self._items.get(path)
+            if item and item[0] == stamp:
+                self._items.move_to_end(path)
+                return item[1]
+        obj = self._load(path, stamp)
+        if obj is None:
+            if mmap:
+                obj = _decode_mapped(path, self.numeric_arrays, None)
+            else:
+                obj = decode(read_file(path), self.numeric_arrays)
+            self._dump(path, stamp, obj)
+        with self._lock:
+            self._items[path] = (stamp, obj)
+            self._items.move_to_end(path)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return obj
 
-def decode_file(luafile):
+    def clear(self):
+        """清空内存中的缓存，磁盘缓存不受影响。"""
+        with self._lock:
+            self._items.clear()
+
+    def _cache_file(self, path):
+        key = path
+        if self.numeric_arrays is not None and self.numeric_arrays != 'list':
+            key += '\0' + self.numeric_arrays
+        name = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name + '.pickle')
+
+    def _load(self, path, stamp):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_file(path), 'rb') as f:
+                cached_stamp, obj = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if cached_stamp != stamp:
+            return None
+        return obj
+
+    def _dump(self, path, stamp, obj):
+        if not self.cache_dir:
+            return
+        # 先写入临时文件再替换，避免其他进程读到写了一半的缓存。
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as f:
+            pickle.dump((stamp, obj), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, self._cache_file(path))
+
+
+def decode_file(luafile, cache=None, numeric_arrays=None, mmap=False,
+        schema=None):
     """将 lua文件 解析成 python 对象。
     将 luafile 解析成字符串，然后调用 :func:`rookout.lua.decode()` 。
 
     :param str luafile: lua文件路径。
+    :param DecodeCache cache: 提供时通过 :class:`DecodeCache` 读取，
+                              此时使用 cache 的 numeric_arrays 设置，
+                              numeric_arrays 与它不同或者提供了 schema 时抛出 :class:`TypeError` 。
+    :param str numeric_arrays: 参见 :func:`rookout.lua.decode()` 。
+    :param bool mmap: 为 True 时将文件映射到内存，使用 :func:`decode_bytes()` 解析，
+                      不必先把整个文件读取并转换成字符串，
+                      多个进程解析同一个文件时还可以共享系统的页面缓存。
+    :param Schema schema: 参见 :func:`rookout.lua.decode()` 。
     :return: python 对象
     :raise: :class:`TypeError`
 
     """
+    if cache is not None:
+        if numeric_arrays is not None and \
+                (numeric_arrays or 'list') != (cache.numeric_arrays or 'list'):
+            raise TypeError(ERRORS['bad_cache'] % (numeric_arrays, cache.numeric_arrays))
+        if schema is not None:
+            raise TypeError(ERRORS['cache_schema'])
+        return cache.decode_file(luafile, mmap)
+    if mmap:
+        return _decode_mapped(luafile, numeric_arrays, schema)
     luastr = read_file(luafile)
-    return decode(luastr)
+    return decode(luastr, numeric_arrays, schema)
+
+def _decode_mapped(luafile, numeric_arrays, schema):
+    with open(luafile, 'rb') as f:
+        # 空文件不能映射
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return lua.decode_bytes(buf, numeric_arrays, schema)
+
+def decode_many(luafiles, workers=None):
+    """使用进程池并行解析多个 lua 文件。
+
+    :param list luafiles: lua文件路径列表。
+    :param int workers: 进程数量，默认为 CPU 核心数。为 1 时在当前进程中依次解析。
+    :return: python 对象列表，顺序与 luafiles 一致。
+    :raise: :class:`TypeError`
+
+    """
+    luafiles = list(luafiles)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(luafiles))
+    if workers <= 1:
+        return [decode_file(luafile) for luafile in luafiles]
+    chunksize = max(1, len(luafiles) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(decode_file, luafiles, chunksize=chunksize))
 
-def decode(text):
+def decode(text, numeric_arrays=None, schema=None):
     """将 lua 解析成 python 对象。
     text 可以是标准的 lua 字符串、或者直接是一个对象。
 
@@ -325,19 +1053,611 @@ def decode(text):
     >>> print(lua.decode(data))
     >>> {"a":1, {"b":[3,4]}}
 
+    只包含整数或只包含浮点数的 table 可以保存成紧凑的数组，
+    每个数字只占用 8 个字节，而不是一个 python 对象：
+
+    >>> lua.decode('{1, 2, 3}', numeric_arrays='array')
+    array('q', [1, 2, 3])
+
     :param str text: lua字符串
+    :param str numeric_arrays: 只包含数字的 table 的保存方式。
+                               None 或 ``'list'`` 保存为 list；
+                               ``'array'`` 保存为 :class:`array.array` （整数为 ``'q'`` ，浮点数为 ``'d'`` ）；
+                               ``'numpy'`` 保存为 ``numpy.ndarray`` ，需要安装 numpy。
+                               整数和浮点数混合或超出 64 位整数范围时仍然保存为 list。
+                               :func:`rookout.lua.encode()` 可以直接转换这些数组。
+    :param Schema schema: 提供时按照 :class:`Schema` 在解析的同时转换和检查每一个值，
+                          此时 numeric_arrays 被忽略。
+                          也可以直接提供 spec ，但每次调用都要重新编译，
+                          多次解析时请先创建 :class:`Schema` 。
+    :return: python 对象
+    :raise: :class:`TypeError`
+
+    """
+    return lua.decode(text, numeric_arrays, schema)
+
+def decode_bytes(buf, numeric_arrays=None, schema=None):
+    """将 UTF-8 编码的 lua 解析成 python 对象。
+
+    直接在 buf 上切分 token，只有切分出来的 token 才会被解码成字符串，
+    不会生成整个文件的 str 副本。
+
+    >>> lua.decode_bytes(b'{a = 1, b = {"x", "y"}}')
+    {'a': 1, 'b': ['x', 'y']}
+
+    :param buf: bytes 、 memoryview 或 mmap 。
+    :param str numeric_arrays: 参见 :func:`rookout.lua.decode()` 。
+    :param Schema schema: 参见 :func:`rookout.lua.decode()` 。
     :return: python 对象
     :raise: :class:`TypeError`
 
     """
-    return lua.decode(text)
+    return lua.decode_bytes(buf, numeric_arrays, schema)
+
+def _iter_tokens(fileobj, chunk_size):
+    """从文件对象中分块读取 lua 源码，逐个生成 token。
+
+    位于块末尾的 token 可能并不完整，会留到下一次读取后再处理。
+    一次读取之后仍然无法生成任何 token 时（例如很长的字符串），
+    下一次读取的大小加倍，避免每读取一块都从头扫描同一个未完成的 token 。
+    """
+    buf = ''
+    eof = False
+    size = chunk_size
+    while not eof:
+        chunk = fileobj.read(size)
+        if chunk:
+            buf += chunk
+        else:
+            eof = True
+        end = len(buf)
+        pos = 0
+        for m in _TOKEN_LEVELS.finditer(buf):
+            tok = m.group('tok')
+            if not eof and (m.end() >= end or tok in _UNFINISHED):
+                break
+            pos = m.end()
+            if tok:
+                yield tok
+        if pos:
+            buf = buf[pos:]
+            size = chunk_size
+        else:
+            size *= 2
+
+def _skip_to_table(tokens):
+    for tok in tokens:
+        if tok[0] == '{':
+            return tok
+    return None
+
+def iterdecode(fileobj, chunk_size=65536):
+    """以事件的方式流式解析 lua 文件中的 table，内存占用与文件大小无关。
+
+    从 fileobj 中分块读取，对每一个解析到的元素生成一个 ``(path, event, value)`` 元组。
+    path 是从最外层 table 到当前元素的键组成的 tuple，
+    顺序元素的键是从 0 开始的整数，与 :func:`decode()` 得到的 list 下标一致。
+    event 为下面三者之一：
+
+    - ``start_table`` 开始一个 table，value 为 None；
+    - ``end_table`` 结束一个 table，value 为 None；
+    - ``value`` 一个标量值。
+
+    最外层 table 之前和之后的内容会被忽略。
+
+    >>> import io
+    >>> for event in lua.iterdecode(io.StringIO('{a = 1, b = {"x"}}')):
+    ...     print(event)
+    ((), 'start_table', None)
+    (('a',), 'value', 1)
+    (('b',), 'start_table', None)
+    (('b', 0), 'value', 'x')
+    (('b',), 'end_table', None)
+    ((), 'end_table', None)
+
+    :param file fileobj: 以文本模式打开的文件对象。
+    :param int chunk_size: 每次读取的字符数。
+    :return: 一个生成器对象。
+    :raise: :class:`TypeError`
+
+    """
+    tokens = _iter_tokens(fileobj, chunk_size)
+    tok = _skip_to_table(tokens)
+    if tok is None:
+        return
+    keys = []
+    idxs = []
+    key = _NOKEY
+    for tok in chain((tok,), tokens):
+        c = tok[0]
+        if c == ',' or c == ';':
+            continue
+        if c == '}':
+            if not idxs or key is not _NOKEY:
+                raise TypeError(ERRORS['unexp_token'] % tok)
+            yield tuple(keys), 'end_table', None
+            idxs.pop()
+            if not idxs:
+                return
+            keys.pop()
+            continue
+        if tok[-1] == '=' and c != '=':
+            if not idxs:
+                raise TypeError(ERRORS['unexp_token'] % tok)
+            key = _key(tok)
+            continue
+        if idxs:
+            if key is _NOKEY:
+                path = keys + [idxs[-1]]
+                idxs[-1] += 1
+            else:
+                path = keys + [key]
+                key = _NOKEY
+        else:
+            path = []
+        if c == '{':
+            yield tuple(path), 'start_table', None
+            if len(tok) > 1:
+                for i, v in enumerate(_number_list(tok)):
+                    yield tuple(path + [i]), 'value', v
+                yield tuple(path), 'end_table', None
+                if not idxs:
+                    return
+                continue
+            keys = path
+            idxs.append(0)
+            continue
+        yield tuple(path), 'value', lua.parse((tok,))
+    if idxs:
+        raise TypeError(ERRORS['unexp_end_table'])
+
+def iteritems(fileobj, chunk_size=65536):
+    """流式读取 lua 文件，逐个生成最外层 table 中的元素。
+
+    每个元素的值都被完整解析成 python 对象，但同一时间只有一个元素驻留在内存中。
+    顺序元素的键是从 0 开始的整数。
+    与 :func:`decode()` 相同，只包含顺序元素的 table 末尾的 nil 不会生成。
+
+    :param file fileobj: 以文本模式打开的文件对象。
+    :param int chunk_size: 每次读取的字符数。
+    :return: 一个生成 ``(key, value)`` 的生成器对象。
+    :raise: :class:`TypeError`
+
+    """
+    tokens = _iter_tokens(fileobj, chunk_size)
+    tok = _skip_to_table(tokens)
+    if tok is None:
+        return
+    if len(tok) > 1:
+        yield from enumerate(_number_list(tok))
+        return
+    idx = 0
+    # 尚未生成的顺序 nil ，后面还有顺序值或者 table 包含键值对时才生成
+    nils = 0
+    keyed = False
+    for tok in tokens:
+        if tok == '}':
+            if keyed:
+                for i in range(idx - nils, idx):
+                    yield i, None
+            return
+        if tok == ',' or tok == ';':
+            continue
+        if tok[-1] == '=' and tok[0] != '=':
+            key = _key(tok)
+            tok = next(tokens, None)
+            if tok is None:
+                break
+            keyed = True
+            yield key, lua.parse(chain((tok,), tokens))
+            continue
+        value = lua.parse(chain((tok,), tokens))
+        idx += 1
+        if value is None:
+            nils += 1
+            continue
+        for i in range(idx - 1 - nils, idx - 1):
+            yield i, None
+        nils = 0
+        yield idx - 1, value
+    raise TypeError(ERRORS['unexp_end_table'])
+
+def _skip_table(text, pos):
+    """跳过一个 table，pos 位于 { 之后，返回对应的 } 之后的位置。"""
+    depth = 1
+    for m in _SKIP.finditer(text, pos):
+        tok = m.group()
+        if tok == '{':
+            depth += 1
+        elif tok == '}':
+            depth -= 1
+            if not depth:
+                return m.end()
+        elif tok == '"' or tok == "'":
+            raise TypeError(ERRORS['unexp_end_string'])
+    raise TypeError(ERRORS['unexp_end_table'])
+
+def _walk_table(text, pos, visit):
+    """逐个扫描 table 中的元素，pos 位于 { 之后。
+
+    每个元素调用一次 ``visit(key, m)`` ，m 是元素的值的第一个 token 的匹配对象，
+    visit 负责跳过或解析这个值，并返回值之后的位置。
+
+    :return: } 之后的位置。
+    """
+    idx = 0
+    key = _NOKEY
+    match = _TOKEN_LEVELS.match
+    while True:
+        m = match(text, pos)
+        tok = m.group('tok')
+        if not tok:
+            raise TypeError(ERRORS['unexp_end_table'])
+        c = tok[0]
+        if c == '}':
+            if key is not _NOKEY:
+                raise TypeError(ERRORS['unexp_token'] % tok)
+            return m.end('tok')
+        if c == ',' or c == ';':
+            pos = m.end()
+            continue
+        if tok[-1] == '=' and (c == '[' or c.isalpha() or c == '_'):
+            if key is not _NOKEY:
+                raise TypeError(ERRORS['unexp_token'] % tok)
+            key = _key(tok)
+            pos = m.end()
+            continue
+        if key is _NOKEY:
+            key = idx
+            idx += 1
+        pos = visit(key, m)
+        key = _NOKEY
+
+def _skip_value(text, m):
+    if m.group('tok') == '{':
+        return _skip_table(text, m.end('tok'))
+    return m.end()
+
+def _decode_at(text, pos):
+    """从 pos 开始解析一个值，返回这个值和它之后的位置。"""
+    ends = [pos]
+    def tokens():
+        for m in _TOKEN_LEVELS.finditer(text, pos):
+            tok = m.group('tok')
+            if not tok:
+                return
+            ends[0] = m.end('tok')
+            yield tok
+    value = lua.parse(tokens())
+    return value, ends[0]
+
+def _find_table(text):
+    """返回 text 中第一个 table 的 { 所在的位置，没有 table 时返回 None。"""
+    pos = 0
+    match = _TOKEN_LEVELS.match
+    while True:
+        m = match(text, pos)
+        tok = m.group('tok')
+        if not tok:
+            return None
+        if tok[0] == '{':
+            return m.start('tok')
+        pos = m.end()
+
+def _scan_table(text, pos):
+    """扫描一个 table 中的元素，pos 位于 { 之后。
+
+    嵌套的 table 被直接跳过，不会生成 python 对象。
+
+    :return: ``([(key, start, end), ...], pos)`` ，
+             start 和 end 是每个元素的值在 text 中的位置，pos 是 } 之后的位置。
+    """
+    entries = []
+    def visit(key, m):
+        start = m.start('tok')
+        if m.group('tok') == '{':
+            end = _skip_table(text, m.end('tok'))
+            entries.append((key, start, end))
+            return end
+        entries.append((key, start, m.end('tok')))
+        return m.end()
+    end = _walk_table(text, pos, visit)
+    return entries, end
+
+class LazyTable(Mapping):
+    """一个只在访问时才解析的 lua table。
+
+    创建时只扫描一遍这一层的元素，记录每个元素的值在源码中的位置，
+    嵌套的 table 被跳过。访问元素时，标量值直接解析，
+    table 值返回一个 :class:`LazyTable` ，同样只在访问时才解析。
+    子 table 在第一次访问时创建，之后再访问同一个键返回同一个对象。
+
+    键的规则与 :func:`decode()` 相同，顺序元素使用从 0 开始的整数作为键。
+
+    :param str text: lua 源码。
+    :param int start: table 的 { 在 text 中的位置。
+
+    """
+
+    def __init__(self, text, start):
+        self.text = text
+        self.start = start
+        entries, self.end = _scan_table(text, start + 1)
+        self._index = {key: (vstart, vend) for key, vstart, vend in entries}
+        self._children = {}
+
+    def __getitem__(self, key):
+        child = self._children.get(key)
+        if child is not None:
+            return child
+        start, end = self._index[key]
+        if self.text[start] == '{':
+            child = self._children[key] = LazyTable(self.text, start)
+            return child
+        return lua.parse(_tokenize(self.text[start:end]))
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return '<LazyTable %d-%d, %d items>' % (self.start, self.end, len(self))
+
+    def span(self, key):
+        """返回 key 对应的值在源码中的位置 ``(start, end)`` 。"""
+        return self._index[key]
+
+    def decode(self):
+        """完整解析这个 table ，结果与 :func:`decode()` 相同。"""
+        return lua.parse(_tokenize(self.text[self.start:self.end]))
+
+def open_lazy(luafile):
+    """打开一个 lua 文件，返回其中第一个 table 对应的 :class:`LazyTable` 。
+
+    只需要读取少数几个键时，这比 :func:`decode_file()` 快得多，占用的内存也少得多：
+
+    >>> data = lua.open_lazy('ani_def_sample.lua')
+    >>> data['spritesheets'].decode()
+    ['ani_misc1', 'ani_misc2']
+    >>> data['animations'][0]['name']
+    'ani_bullet_hit_magic'
+
+    :param str luafile: lua文件路径。
+    :return: :class:`LazyTable`
+    :raise: :class:`TypeError`
+
+    """
+    text = read_file(luafile)
+    pos = _find_table(text)
+    if pos is None:
+        raise TypeError(ERRORS['unexp_table'])
+    return LazyTable(text, pos)
+
+_ANY = object()
+
+_QUERY = re.compile(r"""\[\s*(?:(?P<any>\*)|(?P<index>-?\d+)|"(?P<dq>[^"]*)"|'(?P<sq>[^']*)')\s*\]
+    |\.?(?P<name>[^.\[\]]+)""", re.X)
+
+def _parse_query(query):
+    segments = []
+    pos = 0
+    for m in _QUERY.finditer(query):
+        if m.start() != pos:
+            break
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'any' or value == '*':
+            segments.append(_ANY)
+        elif kind == 'index' or (kind == 'name' and value.isdigit()):
+            segments.append(int(value))
+        else:
+            segments.append(value)
+    if pos != len(query):
+        raise TypeError(ERRORS['bad_query'] % query)
+    return segments
+
+def _select_value(value, segments, results):
+    if not segments:
+        results.append(value)
+        return
+    if isinstance(value, list):
+        items = enumerate(value)
+    elif isinstance(value, dict):
+        items = value.items()
+    else:
+        return
+    seg = segments[0]
+    for key, item in items:
+        if seg is _ANY or key == seg:
+            _select_value(item, segments[1:], results)
+
+def _select(text, pos, segments, results):
+    seg, rest = segments[0], segments[1:]
+    def visit(key, m):
+        if seg is not _ANY and key != seg:
+            return _skip_value(text, m)
+        tok = m.group('tok')
+        if tok == '{':
+            if rest:
+                return _select(text, m.end('tok'), rest, results)
+            value, end = _decode_at(text, m.start('tok'))
+            results.append(value)
+            return end
+        _select_value(lua.parse((tok,)), rest, results)
+        return m.end()
+    return _walk_table(text, pos, visit)
+
+def select(source, query):
+    """从 lua 源码中取出路径与 query 匹配的值，不解析整个 table。
+
+    query 由键组成，使用 . 分隔，也可以使用 ``[0]`` 、 ``["key"]`` 的形式。
+    ``*`` 或 ``[*]`` 匹配任意键。顺序元素的下标从 0 开始，与 :func:`decode()` 一致。
+    不匹配的部分只被扫描跳过，不会生成 python 对象。
+
+    >>> text = '{animations = {{name = "a", frames = {1, 2}}, {name = "b"}}}'
+    >>> lua.select(text, 'animations[*].name')
+    ['a', 'b']
+    >>> lua.select(text, 'animations.0.frames')
+    [[1, 2]]
+
+    :param source: lua 源码字符串，或者以文本模式打开的文件对象。
+    :param str query: 查询路径。
+    :return: 匹配的值组成的 list，按照它们在源码中出现的顺序排列。
+    :raise: :class:`TypeError`
 
-def encode(obj):
+    """
+    text = source.read() if hasattr(source, 'read') else source
+    segments = _parse_query(query)
+    pos = _find_table(text)
+    if pos is None:
+        return []
+    results = []
+    if segments:
+        _select(text, pos + 1, segments, results)
+    else:
+        results.append(_decode_at(text, pos)[0])
+    return results
+
+def _fragment(text, start, value, mode):
+    """将 value 转换成 lua 格式，用于替换 text 中从 start 开始的值。
+    多行的输出使用 start 所在行的缩进和换行符。
+    """
+    out = []
+    lua.dump(value, out.append, 0, mode)
+    fragment = ''.join(out)
+    if '\n' in fragment:
+        lf = text.rfind('\n', 0, start)
+        line = text[lf + 1:start]
+        indent = line[:len(line) - len(line.lstrip())]
+        # 与所在行（位于第一行时是下一行）的换行符保持一致
+        if lf < 0:
+            lf = text.find('\n', start)
+        newline = '\r\n' if lf > 0 and text[lf - 1] == '\r' else '\n'
+        fragment = fragment.replace('\n', newline + indent)
+    return fragment
+
+def _replace_file(path, text):
+    """先写入同一文件夹中的临时文件再替换 path，保留原文件的权限。"""
+    updir = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='',
+            dir=updir, delete=False) as f:
+        try:
+            f.write(text)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    try:
+        os.chmod(f.name, os.stat(path).st_mode & 0o7777)
+        os.replace(f.name, path)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+def patch_file(luafile, changes, mode='compact'):
+    """修改 lua 文件中的部分值，其他内容（包括格式和注释）保持不变。
+
+    不会解析整个文件，只扫描路径经过的 table，找到每个值在源码中的位置，
+    然后用新值转换后的 lua 字符串替换它。结果先写入临时文件，再替换原文件。
+
+    路径的写法与 :func:`select()` 相同，但不能包含 ``*`` ，
+    路径指向的值必须已经存在，否则抛出 :class:`KeyError` 。
+
+    >>> lua.patch_file('ani_def_sample.lua', {'animations.0.loops': 2,
+    ...     'spritesheets[1]': 'ani_misc3'})
+
+    :param str luafile: lua文件路径。
+    :param dict changes: 路径到新值的映射。
+    :param str mode: 新值的输出格式，参见 :func:`encode()` 。
+                     多行的输出会使用原来的值所在行的缩进。
+    :raise: :class:`TypeError` :class:`KeyError`
+
+    """
+    with open(luafile, encoding='utf-8', newline='') as f:
+        text = f.read()
+    pos = _find_table(text)
+    if pos is None:
+        raise TypeError(ERRORS['unexp_table'])
+    # LazyTable 缓存子 table ，多个路径经过同一个 table 时只扫描一次
+    root = LazyTable(text, pos)
+    spans = []
+    for query, value in changes.items():
+        segments = _parse_query(query)
+        if _ANY in segments:
+            raise TypeError(ERRORS['bad_query'] % query)
+        if not segments:
+            start, end = root.start, root.end
+        else:
+            table = root
+            for seg in segments[:-1]:
+                table = table[seg]
+                if not isinstance(table, LazyTable):
+                    raise KeyError(query)
+            start, end = table.span(segments[-1])
+        spans.append((start, end, query, _fragment(text, start, value, mode)))
+    spans.sort(key=lambda span: span[:2])
+    out = []
+    last, last_query = 0, None
+    for start, end, query, fragment in spans:
+        if start < last:
+            raise TypeError(ERRORS['bad_patch'] % (last_query, query))
+        out.append(text[last:start])
+        out.append(fragment)
+        last, last_query = end, query
+    out.append(text[last:])
+    _replace_file(luafile, ''.join(out))
+
+def encode(obj, mode='pretty'):
     """将 python 对象解析成 lua 字符串。
 
+    mode 决定输出的格式：
+
+    ``'pretty'``
+        默认格式，每个键值对占一行并缩进，键名总是写成 ``["key"] = value`` 。
+    ``'compact'``
+        不包含任何空白，合法的标识符直接作为键名，例如 ``{a=1,["b c"]=2}`` ，
+        生成的文件更小，在 lua 中载入也更快。
+    ``'canonical'``
+        与 pretty 相同，但键按照排序后的顺序输出，
+        相同的数据总是得到相同的字符串，可以用来计算 hash 或者比较差异。
+
+    >>> lua.encode({'b': 1, 'a': [1, 2]}, 'compact')
+    '{b=1,a={1,2}}'
+
     :param object obj: 一个 python 对象。
+    :param str mode: 输出格式，可以是 pretty、compact 或 canonical。
     :return: 一个 lua 格式的字符串。
+    :raise: :class:`TypeError`
+
+    """
+    return lua.encode(obj, mode)
+
+def encode_to(obj, fileobj, mode='pretty'):
+    """将 python 对象转换成 lua 格式，直接写入文件对象，不在内存中生成完整的字符串。
+
+    :param object obj: 一个 python 对象。
+    :param file fileobj: 以文本模式打开的文件对象。
+    :param str mode: 输出格式，参见 :func:`rookout.lua.encode()` 。
+    :raise: :class:`TypeError`
+
+    """
+    lua.dump(obj, fileobj.write, mode=mode)
+
+def encode_file(obj, luafile, mode='pretty'):
+    """将 python 对象转换成 lua 格式并保存到文件，是 :func:`decode_file()` 的逆操作。
+
+    :param object obj: 一个 python 对象。
+    :param str luafile: lua文件路径。
+    :param str mode: 输出格式，参见 :func:`rookout.lua.encode()` 。
+    :raise: :class:`TypeError`
 
     """
-    return lua.encode(obj)
+    updir = os.path.dirname(luafile)
+    if updir and not os.path.isdir(updir):
+        os.makedirs(updir)
+    with open(luafile, 'w', encoding='utf-8') as f:
+        encode_to(obj, f, mode)
 
@@ -18,9 +18,254 @@ def test_copy_dir():
     base.copy_dir(souPath, dstPath, True)
     shutil.rmtree(dstPath)
 
+def test_copy_dir_incremental():
+    souPath = os.path.join(workDir, "__TEST_COPY_SOU__")
+    dstPath = os.path.join(workDir, "__TEST_COPY_DST__")
+    for name in ('a.txt', 'sub/b.txt', 'sub/deep/c.txt'):
+        base.write_file(os.path.join(souPath, name), name)
+    try:
+        result = base.copy_dir(souPath, dstPath, incremental=True)
+        assert sorted(result['copied']) == ['a.txt', 'sub/b.txt', 'sub/deep/c.txt']
+        base.write_file(os.path.join(souPath, 'sub/b.txt'), 'changed')
+        base.write_file(os.path.join(dstPath, 'old/d.txt'), 'orphan')
+        result = base.copy_dir(souPath, dstPath, incremental=True, delete=True)
+        assert result['copied'] == ['sub/b.txt']
+        assert sorted(result['skipped']) == ['a.txt', 'sub/deep/c.txt']
+        assert result['deleted'] == ['old/d.txt']
+        assert not os.path.exists(os.path.join(dstPath, 'old'))
+        assert base.read_file(os.path.join(dstPath, 'sub/b.txt')) == 'changed'
+        result = base.copy_dir(souPath, dstPath, incremental=True, compare='hash')
+        assert not result['copied'] and len(result['skipped']) == 3
+        shutil.rmtree(dstPath)
+        result = base.copy_dir(souPath, dstPath, workers=4, link=True)
+        assert len(result['copied']) == 3
+        assert os.path.samefile(os.path.join(souPath, 'a.txt'),
+            os.path.join(dstPath, 'a.txt'))
+        base.write_file(os.path.join(souPath, 'e.txt'), 'e')
+        result = base.copy_dir(souPath, dstPath, incremental=True, workers=4)
+        assert result['copied'] == ['e.txt'] and len(result['skipped']) == 3
+        assert base.read_file(os.path.join(souPath, 'a.txt')) == 'a.txt'
+    finally:
+        shutil.rmtree(souPath)
+        shutil.rmtree(dstPath)
+
+def test_copy_dir_symlink():
+    if not hasattr(os, 'symlink'):
+        return
+    souPath = os.path.join(workDir, "__TEST_COPY_SOU__")
+    dstPath = os.path.join(workDir, "__TEST_COPY_DST__")
+    extPath = os.path.join(workDir, "__TEST_COPY_EXT__")
+    base.write_file(os.path.join(souPath, 'a.txt'), 'a')
+    base.write_file(os.path.join(extPath, 'g.txt'), 'g')
+    try:
+        os.symlink(extPath, os.path.join(souPath, 'link'))
+        result = base.copy_dir(souPath, dstPath, incremental=True)
+        assert sorted(result['copied']) == ['a.txt', 'link/g.txt']
+        result = base.copy_dir(souPath, dstPath, incremental=True, delete=True)
+        assert not result['deleted'] and len(result['skipped']) == 2
+        assert base.read_file(os.path.join(dstPath, 'link', 'g.txt')) == 'g'
+    finally:
+        shutil.rmtree(souPath)
+        shutil.rmtree(extPath)
+        shutil.rmtree(dstPath)
+
 def test_get_files():
     assert len(list(base.get_files(workDir))) > 0
 
+def test_get_files_patterns():
+    rootPath = os.path.join(workDir, "__TEST_GET_FILES__")
+    for name in ('a.py', 'b.txt', 'sub/c.py', 'sub/d.lua', 'skip/e.py'):
+        base.write_file(os.path.join(rootPath, name), name)
+    try:
+        def rel(files):
+            return sorted(os.path.relpath(f, rootPath).replace(os.sep, '/') \
+                for f in files)
+        assert rel(base.get_files(rootPath, ['.py', '.lua'])) == \
+            ['a.py', 'skip/e.py', 'sub/c.py', 'sub/d.lua']
+        assert rel(base.get_files(rootPath, ['.py'], False)) == \
+            ['b.txt', 'sub/d.lua']
+        assert rel(base.get_files(rootPath, includes='*.py',
+            excludes='skip')) == ['a.py', 'sub/c.py']
+        assert rel(base.get_files(rootPath, includes=['sub/*'])) == \
+            ['sub/c.py', 'sub/d.lua']
+        entries = list(base.get_files(rootPath, ['.txt'], entries=True))
+        assert len(entries) == 1 and entries[0].stat().st_size == 5
+        dirs = list(base.list_dir(rootPath, include_file=False, entries=True))
+        assert sorted(e.name for e in dirs) == ['skip', 'sub']
+    finally:
+        shutil.rmtree(rootPath)
+
+def test_get_files_workers():
+    rootPath = os.path.join(workDir, os.pardir)
+    files = list(base.get_files(rootPath, excludes='.git'))
+    assert list(base.get_files(rootPath, excludes='.git', workers=4)) == files
+    unordered = base.get_files(rootPath, excludes='.git', workers=4,
+        ordered=False)
+    assert sorted(unordered) == sorted(files)
+
+def test_manifest():
+    rootPath = os.path.join(workDir, "__TEST_MANIFEST__")
+    indexPath = os.path.join(workDir, "__TEST_MANIFEST__.json")
+    for name in ('a.txt', 'sub/b.txt', 'sub/c.txt'):
+        base.write_file(os.path.join(rootPath, name), name)
+    try:
+        try:
+            base.Manifest.load(indexPath)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError')
+        manifest = base.Manifest.load(indexPath, rootPath)
+        changes = manifest.update(workers=2)
+        assert changes['added'] == ['a.txt', 'sub/b.txt', 'sub/c.txt']
+        manifest.save(indexPath)
+        base.write_file(os.path.join(rootPath, 'sub/b.txt'), 'changed')
+        base.write_file(os.path.join(rootPath, 'd.txt'), 'd')
+        os.remove(os.path.join(rootPath, 'sub/c.txt'))
+        os.utime(os.path.join(rootPath, 'a.txt'), (0, 0))
+        manifest = base.Manifest.load(indexPath)
+        old = dict(manifest.entries)
+        changes = manifest.update()
+        assert changes == {'added':['d.txt'], 'removed':['sub/c.txt'],
+            'modified':['sub/b.txt']}
+        assert base.Manifest.diff(old, manifest) == changes
+        assert manifest.entries['d.txt'][2] == \
+            base.get_md5(os.path.join(rootPath, 'd.txt'))
+    finally:
+        shutil.rmtree(rootPath)
+        os.remove(indexPath)
+
+def test_create_zip():
+    import zipfile
+    rootPath = os.path.normpath(os.path.join(workDir, os.pardir))
+    files = list(base.get_files(os.path.join(rootPath, 'rookout'), ['.py']))
+    pngFile = os.path.join(workDir, "__TEST_CREATE_ZIP__.png")
+    base.write_file(pngFile, 'png' * 100)
+    files.append(pngFile)
+    names = [f[len(rootPath)+1:].replace(os.sep, '/') for f in files]
+    zipPaths = []
+    try:
+        for workers in (None, 4):
+            zipPath = os.path.join(workDir, "__TEST_CREATE_ZIP_%s__.zip"%workers)
+            zipPaths.append(zipPath)
+            base.create_zip(files, len(rootPath)+1, zipPath, workers=workers)
+            with zipfile.ZipFile(zipPath) as zipf:
+                assert zipf.testzip() is None
+                infos = zipf.infolist()
+                assert [i.filename for i in infos] == names
+                assert infos[-1].compress_type == zipfile.ZIP_STORED
+                assert infos[0].compress_type == zipfile.ZIP_DEFLATED
+                assert zipf.read(infos[-1]) == b'png' * 100
+    finally:
+        os.remove(pngFile)
+        for zipPath in zipPaths:
+            os.remove(zipPath)
+
+def test_create_zip_stream():
+    import io
+    import zipfile
+    class Pipe(object):
+        def __init__(self):
+            self.buf = io.BytesIO()
+        def write(self, data):
+            return self.buf.write(data)
+        def flush(self):
+            pass
+    rootPath = os.path.normpath(os.path.join(workDir, os.pardir))
+    files = list(base.get_files(os.path.join(rootPath, 'rookout'), ['.py']))
+    size = sum(os.path.getsize(f) for f in files)
+    for workers in (None, 4):
+        reports = []
+        pipe = Pipe()
+        assert base.create_zip(files, len(rootPath)+1, pipe, workers=workers,
+            progress=reports.append, progress_interval=3600) is None
+        assert len(reports) == 2
+        assert reports[0].files == 1
+        assert reports[-1].files == reports[-1].total_files == len(files)
+        assert reports[-1].bytes == size
+        with zipfile.ZipFile(io.BytesIO(pipe.buf.getvalue())) as zipf:
+            assert zipf.testzip() is None
+            assert len(zipf.namelist()) == len(files)
+    reports = []
+    base.create_zip(files[:1], len(rootPath)+1, Pipe(), progress=reports.append)
+    assert len(reports) == 1 and reports[0].files == 1
+    zipPath = os.path.join(workDir, "__TEST_CREATE_ZIP_FD__.zip")
+    try:
+        with os.fdopen(os.open(zipPath, os.O_WRONLY|os.O_CREAT), 'wb') as f:
+            assert base.create_zip(files, len(rootPath)+1, f, progress=None) is None
+        with zipfile.ZipFile(zipPath) as zipf:
+            assert len(zipf.namelist()) == len(files)
+    finally:
+        os.remove(zipPath)
+
+def test_update_zip():
+    import zipfile
+    souPath = os.path.join(workDir, "__TEST_UPDATE_ZIP__")
+    zipPath = souPath + '.zip'
+    files = [os.path.join(souPath, name) for name in ('a.txt', 'b.txt', 'c.txt')]
+    for f in files:
+        base.write_file(f, os.path.basename(f) * 100)
+    trim = len(souPath) + 1
+    try:
+        base.create_zip(files, trim, zipPath)
+        base.write_file(files[1], 'changed' * 100)
+        files.pop(2)
+        files.append(os.path.join(souPath, 'd.txt'))
+        base.write_file(files[-1], 'd.txt')
+        result = base.update_zip(zipPath, files, trim)
+        assert result == {'reused':['a.txt'], 'compressed':['b.txt', 'd.txt'],
+                'removed':['c.txt']}
+        with zipfile.ZipFile(zipPath) as zipf:
+            assert zipf.testzip() is None
+            assert zipf.namelist() == ['a.txt', 'b.txt', 'd.txt']
+            assert zipf.read('a.txt') == b'a.txt' * 100
+            assert zipf.read('b.txt') == b'changed' * 100
+        result = base.update_zip(zipPath, files, trim, compare='crc', workers=2)
+        assert result['reused'] == ['a.txt', 'b.txt', 'd.txt']
+        os.chmod(zipPath, 0o644)
+        result = base.update_zip(zipPath, files, trim, target_file=zipPath)
+        assert result['reused'] == ['a.txt', 'b.txt', 'd.txt']
+        assert os.stat(zipPath).st_mode & 0o777 == 0o644
+        with zipfile.ZipFile(zipPath) as zipf:
+            assert zipf.read('d.txt') == b'd.txt'
+        badPath = souPath + '_BAD.zip'
+        try:
+            base.update_zip(zipPath, files + [souPath + '/missing'], trim,
+                target_file=badPath)
+        except OSError:
+            pass
+        assert not os.path.exists(badPath)
+    finally:
+        shutil.rmtree(souPath)
+        os.remove(zipPath)
+
+def test_extract_zip():
+    rootPath = os.path.normpath(os.path.join(workDir, os.pardir))
+    files = list(base.get_files(os.path.join(rootPath, 'rookout'), ['.py']))
+    zipPath = os.path.join(workDir, "__TEST_EXTRACT_ZIP__.zip")
+    dstPath = os.path.join(workDir, "__TEST_EXTRACT_ZIP__")
+    base.create_zip(files, len(rootPath)+1, zipPath, progress=None)
+    try:
+        for workers, use_mmap in ((None, False), (4, True)):
+            result = base.extract_zip(zipPath, dstPath, workers=workers,
+                use_mmap=use_mmap)
+            assert len(result['extracted']) == len(files)
+            for f in files:
+                assert base.read_file(os.path.join(dstPath, f[len(rootPath)+1:])) \
+                    == base.read_file(f)
+            shutil.rmtree(dstPath)
+        base.extract_zip(zipPath, dstPath)
+        changed = os.path.join(dstPath, 'rookout', 'base.py')
+        base.write_file(changed, 'changed')
+        result = base.extract_zip(zipPath, dstPath, workers=4)
+        assert result['extracted'] == ['rookout/base.py']
+        assert len(result['skipped']) == len(files) - 1
+        assert base.read_file(changed) == base.read_file(
+            os.path.join(rootPath, 'rookout', 'base.py'))
+    finally:
+        os.remove(zipPath)
+        shutil.rmtree(dstPath)
+
 def test_read_file():
     base.read_file(__file__)
 
@@ -33,3 +278,18 @@ def test_write_file():
 def test_get_md5():
     assert len(base.get_md5(__file__)) == 32
 
+def test_get_hashes():
+    import hashlib
+    with open(__file__, 'rb') as f:
+        data = f.read()
+    algorithms = ('md5', 'sha1', 'sha256', 'blake2b')
+    expected = {name:hashlib.new(name, data).hexdigest() for name in algorithms}
+    assert base.get_hashes(__file__, algorithms, chunk_size=100) == expected
+    assert base.get_hashes(__file__, algorithms, use_mmap=True) == expected
+    assert base.get_md5(__file__, chunk_size=7) == expected['md5']
+    files = list(base.get_files(workDir, ['.py']))
+    md5s = base.get_md5_many(files, workers=4)
+    assert list(md5s) == files and md5s[__file__] == expected['md5']
+    sha1s = base.get_md5_many(files, workers=4, algorithms=['sha1'])
+    assert sha1s[__file__] == {'sha1':expected['sha1']}
+
@@ -2,6 +2,7 @@
 
 import rookout.lua as lua
 import os
+import shutil
 
 def setup():
     pass
@@ -28,6 +29,297 @@ def test_decode_file():
     adict = lua.decode_file(luafile)
     assert len(adict['spritesheets']) == 2
 
+def test_decode_tokens():
+    assert lua.decode('{1, 2.5, -3, 0x10, 1e3}') == [1, 2.5, -3, 16, 1000.0]
+    assert lua.decode('{a = 1; b = "x", ["c d"] = [[long]]}') == \
+            {'a': 1, 'b': 'x', 'c d': 'long'}
+    assert lua.decode('{{1, 2}, {x = true}, nil}') == [[1, 2], {'x': True}]
+    for bad in ('{"abc}', '{a = }', '{1, (}', '{"a" = 1}', '{a = = 1}', '{= 1}',
+            '{a = b = 1}'):
+        try:
+            lua.decode(bad)
+        except TypeError:
+            continue
+        raise AssertionError(bad)
+
+def test_decode_comments():
+    text = r"""-- header {
+    --[[ block { comment ]] local data = {
+        url = "http://host--path", -- trailing
+        --[==[ level ]] comment ]==]
+        text = [==[
+    a ]] b]==],
+        nums = {1, 2, -- one
+            3} --[[ before comma ]] ,
+    }
+    return data -- end"""
+    assert lua.decode(text) == {'url': 'http://host--path',
+            'text': '    a ]] b', 'nums': [1, 2, 3]}
+
+def test_decode_array():
+    big = '{%s}' % ', '.join('{%d}' % i for i in range(100000))
+    ar = lua.decode(big)
+    assert type(ar) is list and len(ar) == 100000 and ar[-1] == [99999]
+    assert lua.decode('{[1] = "a", [100000] = "b"}') == {1: 'a', 100000: 'b'}
+    assert lua.decode('{"a", "b", n = 2}') == {0: 'a', 1: 'b', 'n': 2}
+
+def test_decode_numeric_arrays():
+    from array import array
+    data = lua.decode('{a = {1, 2, 3}, b = {1.5, -2e3}, c = {1, 2.5}, '
+        'd = {-- comment\n 4, 5}, e = {"x", 1}}', numeric_arrays='array')
+    assert data['a'] == array('q', [1, 2, 3])
+    assert data['b'] == array('d', [1.5, -2e3])
+    assert data['c'] == [1, 2.5]
+    assert data['d'] == array('q', [4, 5])
+    assert data['e'] == ['x', 1]
+    assert lua.decode(lua.encode(data)) == {'a': [1, 2, 3], 'b': [1.5, -2e3],
+        'c': [1, 2.5], 'd': [4, 5], 'e': ['x', 1]}
+    assert lua.encode(array('q', [1, 2])) == '{1,2}'
+    assert lua.decode('{nil}', numeric_arrays='array') == []
+    assert lua.decode('{a = {nil}}', numeric_arrays='array') == {'a': []}
+    assert lua.encode(array('q', [0])) == '{0}'
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        assert lua.encode(lua.decode('{1, 2}', numeric_arrays='numpy')) == '{1,2}'
+        assert lua.encode(numpy.array([0])) == '{0}'
+    try:
+        lua.decode('{1}', numeric_arrays='tuple')
+        assert False
+    except TypeError:
+        pass
+
+def test_decode_bytes():
+    luafile = os.path.join(os.path.split(__file__)[0], 'ani_def_sample.lua')
+    adict = lua.decode_file(luafile)
+    assert lua.decode_file(luafile, mmap=True) == adict
+    with open(luafile, 'rb') as f:
+        buf = f.read()
+    assert lua.decode_bytes(buf) == adict
+    assert lua.decode_bytes(memoryview(buf)) == adict
+    text = '{s = "中文", t = [==[a]]b]==]} -- 注释'
+    assert lua.decode_bytes(text.encode('utf-8')) == lua.decode(text)
+    text = '{名字 = 1, café = {值 = true}}'
+    assert lua.decode_bytes(text.encode('utf-8')) == lua.decode(text) == \
+        {'名字': 1, 'café': {'值': True}}
+    try:
+        lua.decode_bytes(b'{"\xff"}')
+        assert False
+    except TypeError:
+        pass
+
+def test_decode_schema():
+    luafile = os.path.join(os.path.split(__file__)[0], 'ani_def_sample.lua')
+    schema = lua.Schema({'spritesheets': [str], 'animations': [{
+        'name': str, 'delay_per_unit': float, 'loops': int,
+        'restore_original_frames': bool, 'frame_name': str,
+        'range': [int], 'sound?': str}]})
+    data = schema.decode_file(luafile)
+    adict = lua.decode_file(luafile)
+    assert data.spritesheets == adict['spritesheets']
+    animation = data.animations[0]
+    assert type(animation).__name__ == 'Animations'
+    assert animation.range == [1, 34] and animation.sound is None
+    assert animation._asdict() == dict(adict['animations'][0], sound=None)
+    assert lua.decode('{a = "1", b = 2, c = {x = {1.0, "2"}}}',
+        schema={'a': int, 'b': float, 'c': {str: [int]}}) == (1, 2.0, {'x': [1, 2]})
+    for text, spec in (('{a = 1, b = 2}', {'a': int}), ('{a = "x"}', {'a': int}),
+            ('{a = {1}}', {'a': int}), ('{}', {'a': int}), ('{1, "x"}', [int]),
+            ('{a = "1.5"}', {'a': int}), ('{a = nil}', {'a': int}),
+            ('{b = nil}', {'b': [int]})):
+        try:
+            lua.decode(text, schema=spec)
+        except TypeError:
+            continue
+        raise AssertionError(text)
+    assert lua.decode('{a = "1e3", b = nil}', schema={'a': int, 'b?': int}) == (1000, None)
+    assert lua.decode('{class = 1, pass = 2}', schema={'class': int, 'pass': int}) \
+        == {'class': 1, 'pass': 2}
+    def positive(v):
+        if v < 0:
+            raise ValueError(v)
+        return v
+    try:
+        lua.decode('{n = -1}', schema={'n': positive})
+    except ValueError as e:
+        assert e.args == (-1,)
+    else:
+        raise AssertionError('ValueError')
+
+def test_decode_many():
+    luafile = os.path.join(os.path.split(__file__)[0], 'ani_def_sample.lua')
+    adict = lua.decode_file(luafile)
+    assert lua.decode_many([luafile] * 4, workers=2) == [adict] * 4
+    assert lua.decode_many([luafile], workers=1) == [adict]
+
+def test_decode_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    texts = ['{%s}' % ', '.join('{n = %d, s = "%d"}' % (i, j) \
+        for i in range(2000)) for j in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lua.decode, texts))
+    for j, result in enumerate(results):
+        assert len(result) == 2000 and result[-1] == {'n': 1999, 's': str(j)}
+
+def test_decode_cache():
+    from array import array
+    workdir = os.path.split(__file__)[0]
+    cachedir = os.path.join(workdir, '__TEST_DECODE_CACHE__')
+    luafile = os.path.join(cachedir, 'sample.lua')
+    os.makedirs(cachedir, exist_ok=True)
+    shutil.copyfile(os.path.join(workdir, 'ani_def_sample.lua'), luafile)
+    try:
+        cache = lua.DecodeCache(maxsize=2, cache_dir=cachedir, use_md5=True)
+        adict = lua.decode_file(luafile, cache=cache)
+        assert cache.decode_file(luafile) is adict
+        assert [f for f in os.listdir(cachedir) if f.endswith('.pickle')]
+        cache = lua.DecodeCache(cache_dir=cachedir, use_md5=True)
+        assert cache.decode_file(luafile) == adict
+        with open(luafile, 'w', encoding='utf-8') as f:
+            f.write('{a = 1}')
+        assert cache.decode_file(luafile) == {'a': 1}
+        with open(luafile, 'w', encoding='utf-8') as f:
+            f.write('{a = {1, 2}}')
+        assert type(cache.decode_file(luafile)['a']) is list
+        arrays = lua.DecodeCache(cache_dir=cachedir, numeric_arrays='array')
+        assert type(arrays.decode_file(luafile)['a']) is array
+        assert type(lua.decode_file(luafile, cache=arrays,
+            numeric_arrays='array')['a']) is array
+        for kwargs in ({'numeric_arrays': 'array'}, {'schema': {'a': [int]}}):
+            try:
+                lua.decode_file(luafile, cache=cache, **kwargs)
+            except TypeError:
+                pass
+            else:
+                raise AssertionError(kwargs)
+        cache.clear()
+        assert lua.decode_file(luafile, cache=cache, mmap=True) == {'a': [1, 2]}
+    finally:
+        shutil.rmtree(cachedir)
+
+def test_iterdecode():
+    luafile = os.path.join(os.path.split(__file__)[0], 'ani_def_sample.lua')
+    adict = lua.decode_file(luafile)
+    with open(luafile, encoding='utf-8') as f:
+        items = dict(lua.iteritems(f, chunk_size=16))
+    assert items == adict
+    with open(luafile, encoding='utf-8') as f:
+        events = list(lua.iterdecode(f, chunk_size=16))
+    assert events[0] == ((), 'start_table', None)
+    assert events[-1] == ((), 'end_table', None)
+    assert (('spritesheets', 1), 'value', 'ani_misc2') in events
+    import io
+    text = '{a = "%s", b = [==[%s]==], c = 1}' % ('x' * 200000, 'y' * 200000)
+    items = dict(lua.iteritems(io.StringIO(text), chunk_size=64))
+    assert items == {'a': 'x' * 200000, 'b': 'y' * 200000, 'c': 1}
+    assert list(lua.iteritems(io.StringIO('{1, nil, nil, 2, nil}'))) == \
+        list(enumerate(lua.decode('{1, nil, nil, 2, nil}')))
+    assert dict(lua.iteritems(io.StringIO('{1, nil, a = 2}'))) == \
+        lua.decode('{1, nil, a = 2}')
+
+def test_open_lazy():
+    luafile = os.path.join(os.path.split(__file__)[0], 'ani_def_sample.lua')
+    data = lua.open_lazy(luafile)
+    assert list(data) == ['spritesheets', 'animations']
+    assert data['spritesheets'].decode() == ['ani_misc1', 'ani_misc2']
+    animation = data['animations'][0]
+    assert animation['name'] == 'ani_bullet_hit_magic'
+    assert animation['loops'] == 1 and animation['range'][1] == 34
+    assert data['animations'] is data['animations']
+    assert data['animations'][0] is animation
+    assert data.decode() == lua.decode_file(luafile)
+
+def test_select():
+    text = """{animations = {
+        {name = "a", frames = {1, 2}},
+        {name = "b", frames = {x = {3}}},
+    }, n = 1}"""
+    assert lua.select(text, 'animations[*].name') == ['a', 'b']
+    assert lua.select(text, 'animations.0.frames') == [[1, 2]]
+    assert lua.select(text, 'animations.*.frames[*]') == [1, 2, [3]]
+    assert lua.select(text, 'animations[1]["name"]') == ['b']
+    assert lua.select(text, 'missing.key') == []
+    luafile = os.path.join(os.path.split(__file__)[0], 'ani_def_sample.lua')
+    with open(luafile, encoding='utf-8') as f:
+        assert lua.select(f, 'spritesheets[1]') == ['ani_misc2']
+
+def test_patch_file():
+    workdir = os.path.split(__file__)[0]
+    luafile = os.path.join(workdir, '__TEST_PATCH_FILE__.lua')
+    shutil.copyfile(os.path.join(workdir, 'ani_def_sample.lua'), luafile)
+    try:
+        adict = lua.decode_file(luafile)
+        lua.patch_file(luafile, {'animations.0.loops': 0,
+            'animations[0].range[1]': 99, 'spritesheets': {'a': [1, 2]}})
+        adict['animations'][0]['loops'] = 0
+        adict['animations'][0]['range'][1] = 99
+        adict['spritesheets'] = {'a': [1, 2]}
+        assert lua.decode_file(luafile) == adict
+        with open(luafile, encoding='utf-8') as f:
+            text = f.read()
+        assert '-- 循环次数' in text and 'spritesheets = {a={1,2}},' in text
+        for bad in ({'animations.0': 1, 'animations.0.loops': 2},
+                {'animations.*.loops': 1}):
+            try:
+                lua.patch_file(luafile, bad)
+                assert False
+            except TypeError:
+                pass
+        try:
+            lua.patch_file(luafile, {'missing.key': 1})
+            assert False
+        except KeyError:
+            pass
+        assert lua.decode_file(luafile) == adict
+        with open(luafile, 'wb') as f:
+            f.write(b'data = {\r\n  a = 1,\r\n  b = 2\r\n}\r\n')
+        lua.patch_file(luafile, {'a': {'x': [1, {'y': 2}]}}, mode='pretty')
+        with open(luafile, 'rb') as f:
+            data = f.read()
+        assert b'\n' not in data.replace(b'\r\n', b'')
+        assert lua.decode_file(luafile) == {'a': {'x': [1, {'y': 2}]}, 'b': 2}
+    finally:
+        os.remove(luafile)
+
+def test_encode_file():
+    workdir = os.path.split(__file__)[0]
+    adict = lua.decode_file(os.path.join(workdir, 'ani_def_sample.lua'))
+    adict['nested'] = {'keys': {10: 'ten', 'a"b': [[1, 2], None, 'x']}}
+    luafile = os.path.join(workdir, '__TEST_ENCODE_FILE__.lua')
+    lua.encode_file(adict, luafile)
+    try:
+        assert lua.decode_file(luafile) == adict
+    finally:
+        os.remove(luafile)
+
+def test_encode_modes():
+    workdir = os.path.split(__file__)[0]
+    adict = lua.decode_file(os.path.join(workdir, 'ani_def_sample.lua'))
+    compact = lua.encode(adict, 'compact')
+    assert lua.decode(compact) == adict
+    assert len(compact) < len(lua.encode(adict))
+    assert not any(c in compact for c in ' \t\n')
+    assert lua.encode({'a': 1, 'end': 2, 'b c': 3, 1: 4}, 'compact') == \
+        '{a=1,["end"]=2,["b c"]=3,[1]=4}'
+    mixed = lua.decode('{43, 54.3, false, string = "value", 9}')
+    # 顺序值仍然写成顺序值，在 lua 中 t[1] 是 43 ，t[4] 是 9
+    assert lua.encode(mixed, 'compact') == '{43,54.3,false,9,string="value"}'
+    for mode in ('pretty', 'canonical'):
+        assert lua.decode(lua.encode(mixed, mode)) == mixed
+    assert lua.encode({1: 'b', 'n': 1, 0: 'a', 5: 'c'}, 'compact') == \
+        '{"a","b",n=1,[5]="c"}'
+    reordered = dict(reversed(list(adict.items())))
+    canonical = lua.encode(adict, 'canonical')
+    assert canonical == lua.encode(reordered, 'canonical')
+    assert lua.decode(canonical) == adict
+    try:
+        lua.encode(adict, 'minified')
+        assert False
+    except TypeError:
+        pass
+
 def differ(value, origin):
     """
     Same: